@@ -1,7 +1,13 @@
 from __future__ import absolute_import
 
+import logging
+
 from celery import shared_task
 
+from .utils import backoff
+
+logger = logging.getLogger(__name__)
+
 
 '''
 Demo Task for testing
@@ -11,3 +17,253 @@ Demo Task for testing
 @shared_task(name="add", bind=True)
 def add(self, x, y):
     return x + y
+
+
+@shared_task(name="find_matches", bind=True, max_retries=5)
+def find_matches(
+    self,
+    match_report_id: int,
+    sealed_identifier: str,  # from matching_helpers.seal_identifier
+    site_id: int,
+    admin_email_template_name: str,
+    match_ids=None,  # set on retry, if matching has already run
+    notified=None,  # set on retry, the notifications already sent
+    local=False,  # match in this task, rather than in the background
+):
+    '''
+    Runs matching for a new MatchReport, then sends the notifications
+    for any matches found.
+
+    Claims the MatchReport (by moving MatchReport.matching_status to
+    running) before doing any work, so a second delivery of this task
+    does nothing. A failed run releases its claim to its retry, which
+    skips matching if it already ran and only sends the notifications
+    that haven't been sent yet.
+
+    Apis that match in other tasks (ex. ShardedMatchingApi) hand the
+    claim to those tasks, which resume this task with the match_ids once
+    they finish, or with local=True if they fail or miss their deadline.
+    '''
+    from callisto_core.delivery.models import MatchReport
+    from callisto_core.reporting import matching_helpers
+    from callisto_core.utils.api import MatchingApi
+
+    # retries, and runs resumed from background matching
+    if self.request.retries or match_ids is not None or local:
+        claimable = [MatchReport.MATCHING_RESUMING]
+    else:
+        claimable = ['', MatchReport.MATCHING_PENDING]
+    if not _claim_match_report(match_report_id, claimable):
+        logger.info(
+            f'MatchReport(pk={match_report_id}) is gone, or already claimed')
+        return []
+
+    match_report = MatchReport.objects.get(pk=match_report_id)
+    identifier = matching_helpers.unseal_identifier(sealed_identifier)
+    notified = set(notified or [])
+
+    try:
+        if match_ids is None and not local:
+            # background matching claims the MatchReport from sharded
+            _set_matching_status(match_report, MatchReport.MATCHING_SHARDED)
+            if MatchingApi.find_matches_in_background(
+                identifier,
+                site_id=site_id,
+                then=find_matches.s(
+                    match_report_id=match_report_id,
+                    sealed_identifier=sealed_identifier,
+                    site_id=site_id,
+                    admin_email_template_name=admin_email_template_name,
+                ),
+                match_report_id=match_report_id,
+            ):
+                logger.info(
+                    f'MatchReport(pk={match_report_id}) matching in background')
+                return []
+            _set_matching_status(match_report, MatchReport.MATCHING_RUNNING)
+        if match_ids is None:
+            matches = matching_helpers.find_matches(
+                identifier, site_id=site_id) or []
+            match_ids = [match.pk for match in matches]
+        else:
+            matches = list(MatchReport.objects.filter(pk__in=match_ids))
+        matching_helpers.MatchNotificationHelper(
+            report=match_report.report,
+            site_id=site_id,
+            admin_email_template_name=admin_email_template_name,
+        ).notify(matches, identifier, notified)
+    except Exception as error:
+        if self.request.retries >= self.max_retries:
+            _set_matching_status(match_report, MatchReport.MATCHING_FAILED)
+            raise
+        logger.exception(error)
+        _set_matching_status(match_report, MatchReport.MATCHING_RESUMING)
+        raise self.retry(
+            exc=error,
+            countdown=backoff(self.request.retries),
+            kwargs={
+                'match_report_id': match_report_id,
+                'sealed_identifier': sealed_identifier,
+                'site_id': site_id,
+                'admin_email_template_name': admin_email_template_name,
+                'match_ids': match_ids,
+                'notified': sorted(notified),
+                'local': local,
+            },
+        )
+
+    _set_matching_status(match_report, MatchReport.MATCHING_DONE)
+    return match_ids
+
+
+@shared_task(name="trial_decrypt_shard")
+def trial_decrypt_shard(
+    api_path: str,  # the ShardedMatchingApi (sub)class that dispatched this
+    sealed_identifier: str,  # from matching_helpers.seal_identifier
+    site_id: int,
+    pk_start: int,
+    pk_end: int,
+):
+    '''
+    Trial decrypts one shard of MatchReports for a ShardedMatchingApi,
+    and returns the pks of the ones that match. Returns None if the shard
+    fails (or hits its soft time limit), so it can be re-run centrally
+    without failing the rest of the shards.
+    '''
+    from django.utils.module_loading import import_string
+    from callisto_core.reporting import matching_helpers
+
+    api = import_string(api_path)()
+    api.identifier = matching_helpers.unseal_identifier(sealed_identifier)
+    api.site_id = site_id
+    try:
+        return api.trial_decrypt_shard(pk_start, pk_end)
+    except Exception:
+        logger.exception(f'matching shard {(pk_start, pk_end)} failed')
+        return None
+
+
+@shared_task(
+    name="finish_sharded_matching",
+    autoretry_for=(Exception,),
+    max_retries=3,
+    retry_backoff=True,
+)
+def finish_sharded_matching(
+    results: list,  # from each trial_decrypt_shard in the chord
+    api_path: str,
+    sealed_identifier: str,
+    site_id: int,
+    shards: list,
+    then=None,  # a signature to call with match_ids= when finished
+    match_report_id=None,  # the MatchReport that find_matches claimed
+):
+    '''
+    Chord callback for ShardedMatchingApi.find_matches_in_background.
+    Re-runs any failed shards, then runs the rest of the transforms.
+
+    Claims the MatchReport from sharded before matching, so it can't
+    run alongside rematch_locally, and releases it again if matching
+    fails so that its retry (or rematch_locally) can pick it up.
+    '''
+    from celery import signature
+    from django.utils.module_loading import import_string
+    from callisto_core.delivery.models import MatchReport
+    from callisto_core.reporting import matching_helpers
+
+    if match_report_id and not _claim_match_report(
+            match_report_id, [MatchReport.MATCHING_SHARDED]):
+        logger.info(
+            f'MatchReport(pk={match_report_id}) is gone, or already claimed')
+        return []
+
+    try:
+        matches = import_string(api_path)().finish_sharded_matching(
+            matching_helpers.unseal_identifier(sealed_identifier),
+            site_id,
+            shards,
+            results,
+        )
+    except Exception:
+        if match_report_id:
+            MatchReport.objects.filter(pk=match_report_id).update(
+                matching_status=MatchReport.MATCHING_SHARDED)
+        raise
+
+    match_ids = [match.pk for match in matches]
+    if then:
+        if match_report_id:
+            MatchReport.objects.filter(pk=match_report_id).update(
+                matching_status=MatchReport.MATCHING_RESUMING)
+        try:
+            signature(then).apply_async(kwargs={'match_ids': match_ids})
+        except Exception:
+            # matching has already flagged these reports, so a retry
+            # would find nothing. notify from this worker instead
+            logger.exception('could not resume find_matches')
+            signature(then).apply(kwargs={'match_ids': match_ids})
+    return match_ids
+
+
+@shared_task(name="rematch_locally")
+def rematch_locally(
+    match_report_id: int,
+    then: dict,  # the find_matches signature to resume
+):
+    '''
+    Takes over from background matching that hasn't finished by its
+    deadline, and resumes find_matches with local=True. Does nothing if
+    the background matching finished (or started to finish) first.
+    '''
+    from celery import signature
+    from callisto_core.delivery.models import MatchReport
+
+    if not MatchReport.objects.filter(
+        pk=match_report_id,
+        matching_status=MatchReport.MATCHING_SHARDED,
+    ).update(matching_status=MatchReport.MATCHING_RESUMING):
+        return False
+    logger.warning(
+        f'MatchReport(pk={match_report_id}) background matching '
+        'did not finish, matching locally')
+    signature(then).apply_async(kwargs={'local': True})
+    return True
+
+
+@shared_task(name="sharded_matching_failed")
+def sharded_matching_failed(
+    request,
+    exc,
+    traceback,
+    match_report_id: int,
+    then: dict,  # the find_matches signature to resume
+):
+    '''
+    Error callback for the finish_sharded_matching chord. Called when a
+    shard is lost or expires, or when finish_sharded_matching has run
+    out of retries
+    '''
+    logger.error(
+        f'MatchReport(pk={match_report_id}) background matching failed: '
+        f'{exc!r}')
+    return rematch_locally(match_report_id, then)
+
+
+def _claim_match_report(match_report_id, claimable):
+    '''
+    moves a MatchReport with a matching_status in claimable to running,
+    in a single conditional UPDATE. returns False if another run of the
+    task got there first (or the MatchReport was withdrawn)
+    '''
+    from callisto_core.delivery.models import MatchReport
+    return MatchReport.objects.filter(
+        pk=match_report_id,
+        matching_status__in=claimable,
+    ).update(matching_status=MatchReport.MATCHING_RUNNING) == 1
+
+
+def _set_matching_status(match_report, status):
+    match_report.matching_status = status
+    type(match_report).objects.filter(
+        pk=match_report.pk,
+    ).update(matching_status=status)
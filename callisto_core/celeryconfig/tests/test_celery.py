@@ -1,6 +1,17 @@
-from django.test import TestCase
+from unittest.mock import Mock, patch
 
+from celery.exceptions import TimeoutError
+
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+
+from callisto_core.celeryconfig import tasks
 from callisto_core.celeryconfig.tasks import add
+from callisto_core.delivery.models import MatchReport
+from callisto_core.reporting import matching_helpers
+from callisto_core.reporting.api import ShardedMatchingApi
+from callisto_core.tests.reporting.base import MatchSetup
+from callisto_core.tests.test_base import ReportFlowHelper
 
 
 class TestCelery(TestCase):
@@ -11,3 +22,383 @@ class TestCelery(TestCase):
     def test_task_result(self):
         result = add.delay(1, 2)
         self.assertEqual(result.get(timeout=3), 3)
+
+
+class FindMatchesTaskHelper(MatchSetup):
+    admin_email_template_name = \
+        'callisto_core/accounts/match_confirmation_callisto_team.html'
+
+    def run_task(self, match_report):
+        return tasks.find_matches.delay(
+            match_report_id=match_report.pk,
+            sealed_identifier=matching_helpers.seal_identifier('test1'),
+            site_id=1,
+            admin_email_template_name=self.admin_email_template_name,
+        ).get()
+
+
+@patch.object(matching_helpers.MatchNotificationHelper, 'notify')
+class FindMatchesTaskTest(FindMatchesTaskHelper):
+
+    def test_identifier_can_be_sealed(self, notify):
+        sealed = matching_helpers.seal_identifier('test1')
+        self.assertNotIn('test1', sealed)
+        self.assertEqual(matching_helpers.unseal_identifier(sealed), 'test1')
+
+    def test_task_finds_and_notifies_matches(self, notify):
+        self.create_match(self.user1, 'test2')
+        self.create_match(self.user2, 'test1')
+        self.create_match(self.user3, 'test1', find_matches=False)
+        match_report = MatchReport.objects.latest('pk')
+
+        match_ids = self.run_task(match_report)
+
+        self.assertEqual(len(match_ids), 2)
+        self.assert_matches_found_for('test1')
+        self.assertEqual(notify.call_count, 1)
+        match_report.refresh_from_db()
+        self.assertEqual(
+            match_report.matching_status, MatchReport.MATCHING_DONE)
+
+    def test_task_is_idempotent(self, notify):
+        self.create_match(self.user1, 'test1', find_matches=False)
+        match_report = MatchReport.objects.latest('pk')
+        self.run_task(match_report)
+        with patch.object(
+            matching_helpers, 'resolve_decryptable',
+        ) as resolve_decryptable:
+            self.run_task(match_report)
+        self.assertFalse(resolve_decryptable.called)
+        self.assertEqual(notify.call_count, 1)
+
+    def test_task_does_nothing_if_already_claimed(self, notify):
+        self.create_match(self.user1, 'test1', find_matches=False)
+        match_report = MatchReport.objects.latest('pk')
+        MatchReport.objects.filter(pk=match_report.pk).update(
+            matching_status=MatchReport.MATCHING_RUNNING)
+        with patch.object(
+            matching_helpers, 'resolve_decryptable',
+        ) as resolve_decryptable:
+            self.assertEqual(self.run_task(match_report), [])
+        self.assertFalse(resolve_decryptable.called)
+        self.assertFalse(notify.called)
+
+    def test_task_ignores_withdrawn_match_reports(self, notify):
+        self.create_match(self.user1, 'test1', find_matches=False)
+        match_report = MatchReport.objects.latest('pk')
+        match_report.report.withdraw_from_matching()
+        self.assertEqual(self.run_task(match_report), [])
+        self.assertFalse(notify.called)
+
+
+@patch.object(
+    matching_helpers.MatchNotificationHelper, 'match_confirmation_email_to_callisto')
+@patch.object(
+    matching_helpers.MatchNotificationHelper, 'slack_match_notification',
+    side_effect=[ConnectionError, None])
+@patch.object(
+    matching_helpers.MatchNotificationHelper, 'notify_owner_of_match')
+@patch.object(
+    matching_helpers.MatchNotificationHelper, 'notify_authority_of_matches')
+@patch.object(
+    matching_helpers.MatchNotificationHelper, 'notify_owner_of_submission')
+@patch.object(tasks, 'backoff', return_value=0)
+class FindMatchesTaskRetryTest(FindMatchesTaskHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test1', find_matches=False)
+        self.match_report = MatchReport.objects.latest('pk')
+
+    def test_retry_does_not_rematch(self, *mocks):
+        with patch.object(
+            matching_helpers, 'resolve_decryptable',
+            wraps=matching_helpers.resolve_decryptable,
+        ) as resolve_decryptable:
+            match_ids = self.run_task(self.match_report)
+        self.assertEqual(resolve_decryptable.call_count, 1)
+        self.assertEqual(len(match_ids), 2)
+        self.match_report.refresh_from_db()
+        self.assertEqual(
+            self.match_report.matching_status, MatchReport.MATCHING_DONE)
+
+    def test_retry_only_sends_unsent_notifications(
+        self,
+        backoff,
+        owner_of_submission,
+        authority_of_matches,
+        owner_of_match,
+        slack,
+        callisto_team,
+    ):
+        self.run_task(self.match_report)
+        self.assertEqual(owner_of_submission.call_count, 1)
+        self.assertEqual(authority_of_matches.call_count, 1)
+        self.assertEqual(len(authority_of_matches.call_args[0][0]), 2)
+        self.assertEqual(owner_of_match.call_count, 2)
+        self.assertEqual(slack.call_count, 2)
+        self.assertEqual(callisto_team.call_count, 1)
+
+    def test_redelivery_does_not_resume_a_retry(self, *mocks):
+        MatchReport.objects.filter(pk=self.match_report.pk).update(
+            matching_status=MatchReport.MATCHING_RESUMING)
+        self.assertEqual(self.run_task(self.match_report), [])
+        self.assert_matches_found_false()
+
+
+@override_settings(
+    CALLISTO_MATCHING_API='callisto_core.reporting.api.ShardedMatchingApi',
+    CALLISTO_MATCHING_SHARDS=3,
+)
+class ShardedMatchingTest(MatchSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test2', find_matches=False)
+        self.create_match(self.user3, 'test1', find_matches=False)
+        self.create_match(self.user4, 'test1', find_matches=False)
+
+    def find_matches(self):
+        return ShardedMatchingApi().find_matches('test1')
+
+    def test_pk_range_is_split_into_shards(self):
+        self.assertEqual(
+            matching_helpers.split_pk_range(1, 10, 3),
+            [(1, 4), (4, 7), (7, 11)],
+        )
+        self.assertEqual(
+            matching_helpers.split_pk_range(4, 5, 3),
+            [(4, 5), (5, 6)],
+        )
+
+    def test_each_shard_is_a_task(self):
+        with patch.object(
+            tasks.trial_decrypt_shard, 'delay',
+            wraps=tasks.trial_decrypt_shard.delay,
+        ) as delay:
+            matches = self.find_matches()
+        self.assertEqual(delay.call_count, 3)
+        self.assertEqual(len(matches), 3)
+        self.assert_matches_found_for('test1')
+
+    def test_shard_tasks_get_a_sealed_identifier(self):
+        with patch.object(
+            tasks.trial_decrypt_shard, 'delay',
+            wraps=tasks.trial_decrypt_shard.delay,
+        ) as delay:
+            self.find_matches()
+        for args in delay.call_args_list:
+            self.assertNotIn('test1', args[0])
+
+    def test_shards_that_time_out_are_run_locally(self):
+        result = Mock(get=Mock(side_effect=TimeoutError))
+        with patch.object(
+            tasks.trial_decrypt_shard, 'delay', return_value=result,
+        ):
+            matches = self.find_matches()
+        self.assertEqual(len(matches), 3)
+        self.assert_matches_found_for('test1')
+
+    def test_only_failed_shards_are_run_locally(self):
+        failed_result = Mock(get=Mock(side_effect=ConnectionError))
+        with patch.object(
+            tasks.trial_decrypt_shard, 'delay', side_effect=[
+                tasks.trial_decrypt_shard.delay(
+                    'callisto_core.reporting.api.ShardedMatchingApi',
+                    matching_helpers.seal_identifier('test1'),
+                    None, 1, 2,
+                ),
+                failed_result,
+                ConnectionError,
+            ],
+        ), patch.object(
+            ShardedMatchingApi, 'trial_decrypt_shard',
+            autospec=True, side_effect=ShardedMatchingApi.trial_decrypt_shard,
+        ) as trial_decrypt_shard:
+            matches = self.find_matches()
+        self.assertEqual(trial_decrypt_shard.call_count, 2)
+        self.assertEqual(len(matches), 3)
+
+    def test_no_match_reports(self):
+        MatchReport.objects.all().delete()
+        with patch.object(tasks.trial_decrypt_shard, 'delay') as delay:
+            self.assertEqual(self.find_matches(), [])
+        self.assertFalse(delay.called)
+
+    def test_failed_shard_tasks_return_none(self):
+        with patch.object(
+            ShardedMatchingApi, 'trial_decrypt_shard',
+            side_effect=ConnectionError,
+        ):
+            self.assertIsNone(tasks.trial_decrypt_shard(
+                'callisto_core.reporting.api.ShardedMatchingApi',
+                matching_helpers.seal_identifier('test1'),
+                None, 1, 2,
+            ))
+
+
+@override_settings(
+    CALLISTO_MATCHING_API='callisto_core.reporting.api.ShardedMatchingApi',
+    CALLISTO_MATCHING_SHARDS=3,
+)
+@patch.object(matching_helpers.MatchNotificationHelper, 'notify')
+class ShardedFindMatchesTaskTest(FindMatchesTaskHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test2', find_matches=False)
+        self.create_match(self.user3, 'test1', find_matches=False)
+        self.match_report = MatchReport.objects.latest('pk')
+
+    def test_task_does_not_wait_on_shards(self, notify):
+        with patch.object(
+            ShardedMatchingApi, '_gather_shards',
+        ) as gather_shards:
+            self.run_task(self.match_report)
+        self.assertFalse(gather_shards.called)
+        self.assertEqual(notify.call_count, 1)
+        self.assertEqual(len(notify.call_args[0][0]), 2)
+        self.assert_matches_found_for('test1')
+        self.match_report.refresh_from_db()
+        self.assertEqual(
+            self.match_report.matching_status, MatchReport.MATCHING_DONE)
+
+    def test_failed_shards_are_run_by_the_chord_callback(self, notify):
+        trial_decrypt_shard = ShardedMatchingApi.trial_decrypt_shard
+        calls = []
+
+        def fail_first_shard(api, pk_start, pk_end):
+            calls.append((pk_start, pk_end))
+            if len(calls) == 1:
+                raise ConnectionError
+            return trial_decrypt_shard(api, pk_start, pk_end)
+
+        with patch.object(
+            ShardedMatchingApi, 'trial_decrypt_shard',
+            autospec=True, side_effect=fail_first_shard,
+        ):
+            self.run_task(self.match_report)
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(calls[0], calls[-1])
+        self.assertEqual(len(notify.call_args[0][0]), 2)
+
+    def test_undispatched_chords_match_locally(self, notify):
+        with patch.object(
+            tasks.finish_sharded_matching, 's', side_effect=ConnectionError,
+        ):
+            self.run_task(self.match_report)
+        self.assertEqual(len(notify.call_args[0][0]), 2)
+        self.match_report.refresh_from_db()
+        self.assertEqual(
+            self.match_report.matching_status, MatchReport.MATCHING_DONE)
+
+    def test_raising_shard_tasks_match_locally(self, notify):
+        with patch.object(
+            tasks.trial_decrypt_shard, 'run', side_effect=ConnectionError,
+        ), patch.object(tasks.sharded_matching_failed, 'run') as errback:
+            self.run_task(self.match_report)
+        self.assertFalse(errback.called)
+        self.assertEqual(notify.call_count, 1)
+        self.assertEqual(len(notify.call_args[0][0]), 2)
+        self.match_report.refresh_from_db()
+        self.assertEqual(
+            self.match_report.matching_status, MatchReport.MATCHING_DONE)
+
+    def test_raising_chord_callbacks_are_retried(self, notify):
+        finish_sharded_matching = ShardedMatchingApi.finish_sharded_matching
+        calls = []
+
+        def fail_once(api, *args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise ConnectionError
+            return finish_sharded_matching(api, *args)
+
+        with patch.object(
+            ShardedMatchingApi, 'finish_sharded_matching',
+            autospec=True, side_effect=fail_once,
+        ):
+            self.run_task(self.match_report)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(notify.call_count, 1)
+        self.assertEqual(len(notify.call_args[0][0]), 2)
+        self.match_report.refresh_from_db()
+        self.assertEqual(
+            self.match_report.matching_status, MatchReport.MATCHING_DONE)
+
+    def then(self):
+        return tasks.find_matches.s(
+            match_report_id=self.match_report.pk,
+            sealed_identifier=matching_helpers.seal_identifier('test1'),
+            site_id=1,
+            admin_email_template_name=self.admin_email_template_name,
+        )
+
+    def test_failed_chords_match_locally(self, notify):
+        self.match_report.matching_status = MatchReport.MATCHING_SHARDED
+        self.match_report.save()
+        tasks.sharded_matching_failed(
+            Mock(id='chord'), ConnectionError(), None,
+            self.match_report.pk, self.then(),
+        )
+        self.assertEqual(notify.call_count, 1)
+        self.assertEqual(len(notify.call_args[0][0]), 2)
+        self.match_report.refresh_from_db()
+        self.assertEqual(
+            self.match_report.matching_status, MatchReport.MATCHING_DONE)
+
+    def test_deadline_is_scheduled(self, notify):
+        with patch.object(tasks.rematch_locally, 'apply_async') as deadline:
+            self.run_task(self.match_report)
+        self.assertEqual(deadline.call_count, 1)
+        self.assertEqual(
+            deadline.call_args[0][0][0], self.match_report.pk)
+        self.assertEqual(
+            deadline.call_args[1]['countdown'], ShardedMatchingApi().deadline)
+
+    def test_deadline_does_nothing_once_matching_finishes(self, notify):
+        self.run_task(self.match_report)
+        notify.reset_mock()
+        tasks.rematch_locally(self.match_report.pk, self.then())
+        self.assertFalse(notify.called)
+        self.match_report.refresh_from_db()
+        self.assertEqual(
+            self.match_report.matching_status, MatchReport.MATCHING_DONE)
+
+
+@override_settings(CALLISTO_MATCHING_ASYNC=True)
+class BackgroundMatchingViewTest(ReportFlowHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.client_post_report_creation()
+
+    def run_commit_hooks(self):
+        # TestCase never commits, so on_commit callbacks are run by hand
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for _, callback in callbacks:
+            callback()
+
+    def test_matching_is_queued(self):
+        with patch.object(tasks.find_matches, 'delay') as delay:
+            self.client_post_matching_enter()
+            self.run_commit_hooks()
+        match_report = MatchReport.objects.get()
+        self.assertEqual(
+            match_report.matching_status, MatchReport.MATCHING_PENDING)
+        delay.assert_called_once()
+        self.assertEqual(
+            delay.call_args[1]['match_report_id'], match_report.pk)
+
+    def test_matching_is_queued_after_commit(self):
+        with patch.object(tasks.find_matches, 'delay') as delay:
+            with transaction.atomic():
+                self.client_post_matching_enter()
+                self.assertFalse(delay.called)
+            # still inside the test's transaction
+            self.assertFalse(delay.called)
+            self.run_commit_hooks()
+        delay.assert_called_once()
@@ -88,6 +88,10 @@ class ReportAccessForm(
         except CryptoError:
             return self._decryption_failed()
 
+    def save(self, commit=True):
+        # entering the passphrase doesn't change the report
+        return super().save(commit=False)
+
     def _decrypt_report(self):
         self.decrypted_report = self.report.decrypt_record(self.data['key'])
         return self.data['key']
@@ -1,4 +1,6 @@
 import base64
+import functools
+import hashlib
 
 import argon2
 
@@ -7,13 +9,18 @@ from django.contrib.auth.hashers import (
     BasePasswordHasher, PBKDF2PasswordHasher,
 )
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.utils.encoding import force_bytes
 from django.utils.module_loading import import_string
 
+from . import kdf
+
 
 # Portions of the below implementation are copyright the Django Software Foundation and individual contributors, and
 # are under the BSD-3 Clause License:
 # https://github.com/django/django/blob/master/LICENSE
+@functools.lru_cache()
 def get_hashers():
     hashers = []
     for hasher_path in settings.KEY_HASHERS:
@@ -26,11 +33,19 @@ def get_hashers():
     return hashers
 
 
+@functools.lru_cache()
 def get_hashers_by_algorithm():
     hashers = get_hashers()
     return {hasher.algorithm: hasher for hasher in hashers}
 
 
+@receiver(setting_changed)
+def reset_hashers(**kwargs):
+    if kwargs['setting'] == 'KEY_HASHERS':
+        get_hashers.cache_clear()
+        get_hashers_by_algorithm.cache_clear()
+
+
 def get_hasher(algorithm='default'):
     if algorithm == 'default':
         return get_hashers()[0]
@@ -59,25 +74,65 @@ def identify_hasher(encoded):
 
 
 def make_key(encode_prefix, key, salt):
-    iterations = None
+    '''
+    Re-derives a key with the hasher and parameters from its encode prefix
+    (or from the legacy salt). Runs on the kdf pool.
+    '''
+    return kdf.run(_make_key, encode_prefix, key, salt)
+
+
+def derive_key(hasher, key, salt, params=None):
+    '''hasher.derive, run on the kdf pool'''
+    return kdf.run(hasher.derive, key, salt, params)
+
+
+def must_update(encode_prefix):
+    '''
+    True if keys with this encode prefix weren't derived with the default
+    hasher and its current parameters
+    '''
+    hasher = identify_hasher(encode_prefix)
+    if hasher.algorithm != get_hasher().algorithm:
+        return True
+    elif hasher.algorithm == 'argon2':
+        # must_update expects a full encoded key, so add an empty one
+        return hasher.must_update(encode_prefix + '$')
+    else:
+        return hasher.must_update(encode_prefix)
+
+
+class StretchedKey(object):
+    '''
+    A key already derived from a passphrase. Can be used in place of the
+    passphrase, for the report whose encode_prefix and salt it was
+    derived with.
+    '''
+
+    def __init__(self, key: bytes, encode_prefix: str, salt: str = None):
+        self.key = key
+        self.encode_prefix = encode_prefix
+        self.salt = salt
+
+    def __bool__(self):
+        return bool(self.key)
+
+
+def _make_key(encode_prefix, key, salt):
     hasher = identify_hasher(encode_prefix)
 
     if not encode_prefix:
         assert salt is not None
-        iterations = settings.ORIGINAL_KEY_ITERATIONS
+        params = {'iterations': settings.ORIGINAL_KEY_ITERATIONS}
     else:
-        salt = encode_prefix.rsplit('$', 1)[1]
-
-    if encode_prefix and hasher.algorithm == 'pbkdf2_sha256':
-        iterations = encode_prefix.split('$')[1]
+        params, salt = hasher.params_from_prefix(encode_prefix)
 
-    encoded = hasher.encode(key, salt, iterations=iterations)
+    prefix, stretched_key = hasher.derive(key, salt, params)
     if hasher.algorithm == 'pbkdf2_sha256' and hasher.must_update(
             encode_prefix):
-        hasher.harden_runtime(key, encoded)
+        # harden_runtime only reads the prefix of the encoded key
+        hasher.harden_runtime(key, prefix + '$')
 
-    prefix, key = hasher.split_encoded(encoded)
-    return prefix, key
+    return prefix, stretched_key
 
 
 class PBKDF2KeyHasher(PBKDF2PasswordHasher):
@@ -88,6 +143,31 @@ class PBKDF2KeyHasher(PBKDF2PasswordHasher):
     """
     iterations = settings.KEY_ITERATIONS
 
+    def derive(self, key, salt, params=None):
+        """
+        Stretches the key without encoding it. params may set iterations,
+        and default to the current settings.
+
+        Returns a prefix, in the same format as split_encoded, and a
+        stretched key.
+        """
+        assert key is not None
+        assert salt and '$' not in salt
+        iterations = int((params or {}).get('iterations') or self.iterations)
+        stretched_key = hashlib.pbkdf2_hmac(
+            self.digest().name,
+            force_bytes(key),
+            force_bytes(salt),
+            iterations,
+        )
+        return f'{self.algorithm}${iterations}${salt}', stretched_key
+
+    def params_from_prefix(self, encode_prefix):
+        """Returns the derive params and the salt in an encode prefix."""
+        algorithm, iterations, salt = encode_prefix.split('$', 2)
+        assert algorithm == self.algorithm
+        return {'iterations': int(iterations)}, salt
+
     def must_update(self, encode_prefix):
         if not encode_prefix:
             iterations = settings.ORIGINAL_KEY_ITERATIONS
@@ -136,6 +216,52 @@ class Argon2KeyHasher(BasePasswordHasher):
         )
         return self.algorithm + data.decode('utf-8')
 
+    def derive(self, key, salt, params=None):
+        """
+        Stretches the key without encoding it. params may set time_cost,
+        memory_cost, parallelism and version, and default to the current
+        settings.
+
+        Returns a prefix, in the same format as split_encoded, and a
+        stretched key.
+        """
+        assert key is not None
+        assert salt and '$' not in salt
+        params = {
+            'time_cost': self.time_cost,
+            'memory_cost': self.memory_cost,
+            'parallelism': self.parallelism,
+            'version': argon2.low_level.ARGON2_VERSION,
+            **(params or {}),
+        }
+        stretched_key = argon2.low_level.hash_secret_raw(
+            force_bytes(key),
+            force_bytes(salt),
+            hash_len=32,
+            type=argon2.low_level.Type.I,
+            **params,
+        )
+        prefix = '{algorithm}$argon2i$v={version}$m={memory_cost},t={time_cost},p={parallelism}${salt}'.format(
+            algorithm=self.algorithm,
+            salt=salt,
+            **params,
+        )
+        return prefix, stretched_key
+
+    def params_from_prefix(self, encode_prefix):
+        """Returns the derive params and the salt in an encode prefix."""
+        # _decode expects a full encoded key, so add an empty one
+        (algorithm, variety, version, time_cost, memory_cost, parallelism,
+            salt, data) = self._decode(encode_prefix + '$')
+        assert algorithm == self.algorithm
+        params = {
+            'time_cost': time_cost,
+            'memory_cost': memory_cost,
+            'parallelism': parallelism,
+            'version': version,
+        }
+        return params, salt
+
     def verify(self, key, encoded):
         algorithm, rest = encoded.split('$', 1)
         assert algorithm == self.algorithm
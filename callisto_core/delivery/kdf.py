@@ -0,0 +1,117 @@
+'''
+
+Runs key derivations on a bounded thread pool, so a burst of logins
+or submissions can't run an unbounded number of memory hard derivations
+at once. argon2 and hashlib's pbkdf2 release the GIL, so the pool still
+uses every core it is allowed.
+
+Configured via:
+    CALLISTO_KDF_MAX_CONCURRENCY: derivations run at once, per process.
+        Defaults to 1. The cap isn't shared between processes, so a node
+        runs up to this many derivations per worker process. Set it to
+        the node's budget (ex. its cores, or its memory divided by
+        ARGON2_MEM_COST) divided by the worker processes on the node.
+        None or 0 runs derivations inline in the calling thread
+    CALLISTO_KDF_MAX_QUEUE: derivations allowed to wait for the pool
+    CALLISTO_KDF_QUEUE_TIMEOUT: seconds to wait for a place in the queue,
+        before raising TimeoutError
+
+'''
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_executors = {}
+_executors_guard = threading.Lock()
+_local = threading.local()
+_stats_guard = threading.Lock()
+_stats = {
+    'derivations': 0,
+    'rejected': 0,
+    'wait_seconds': 0.0,
+    'max_wait_seconds': 0.0,
+}
+
+
+def max_concurrency():
+    return getattr(settings, 'CALLISTO_KDF_MAX_CONCURRENCY', 1)
+
+
+def max_queue():
+    return getattr(settings, 'CALLISTO_KDF_MAX_QUEUE', 64)
+
+
+def queue_timeout():
+    return getattr(settings, 'CALLISTO_KDF_QUEUE_TIMEOUT', 30)
+
+
+def get_executor():
+    '''
+    lazily creates one executor per process. executors are keyed on
+    the pid and concurrency, because they don't survive a fork
+    '''
+    executor_id = (os.getpid(), max_concurrency(), max_queue())
+    with _executors_guard:
+        if executor_id not in _executors:
+            _executors[executor_id] = (
+                ThreadPoolExecutor(max_workers=executor_id[1]),
+                # running plus waiting derivations
+                threading.BoundedSemaphore(executor_id[1] + executor_id[2]),
+            )
+        return _executors[executor_id]
+
+
+def stats() -> dict:
+    '''totals for every derivation run through this process'''
+    with _stats_guard:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_guard:
+        _stats.update(
+            derivations=0, rejected=0, wait_seconds=0.0, max_wait_seconds=0.0)
+
+
+def run(func, *args, **kwargs):
+    '''
+    Runs func (a key derivation) on the kdf pool, and returns its result.
+    Derivations started from inside the pool (ex. hardening a pbkdf2 key)
+    run inline, so they can't deadlock waiting for a free thread.
+    '''
+    if not max_concurrency() or getattr(_local, 'in_pool', False):
+        return func(*args, **kwargs)
+
+    executor, slots = get_executor()
+    if not slots.acquire(timeout=queue_timeout()):
+        with _stats_guard:
+            _stats['rejected'] += 1
+        raise TimeoutError('key derivation queue is full')
+    try:
+        future = executor.submit(
+            _run_in_pool, time.perf_counter(), func, args, kwargs)
+        return future.result()
+    finally:
+        slots.release()
+
+
+def _run_in_pool(submitted, func, args, kwargs):
+    wait_seconds = time.perf_counter() - submitted
+    with _stats_guard:
+        _stats['derivations'] += 1
+        _stats['wait_seconds'] += wait_seconds
+        _stats['max_wait_seconds'] = max(
+            _stats['max_wait_seconds'], wait_seconds)
+    logger.debug(f'key derivation waited {wait_seconds:.3f}s for the pool')
+
+    _local.in_pool = True
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _local.in_pool = False
@@ -0,0 +1,165 @@
+import itertools
+import json
+import statistics
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from callisto_core.delivery.hashers import Argon2KeyHasher, PBKDF2KeyHasher
+
+
+class Command(BaseCommand):
+    help = '''
+        times the key hashers on this host across a grid of parameters,
+        and recommends the strongest settings that fit a latency target
+        and a memory budget. prints the results as json.
+    '''
+
+    key = 'calibration key'
+    salt = 'calibrationsalt'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--time-costs', nargs='+', type=int, default=[1, 2, 4],
+            help='ARGON2_TIME_COST values to try')
+        parser.add_argument(
+            '--memory-costs', nargs='+', type=int, default=[512, 8192, 65536],
+            help='ARGON2_MEM_COST values (in KiB) to try')
+        parser.add_argument(
+            '--parallelisms', nargs='+', type=int, default=[1, 2],
+            help='ARGON2_PARALLELISM values to try')
+        parser.add_argument(
+            '--iterations', nargs='+', type=int, default=[100, 10000, 100000, 300000],
+            help='KEY_ITERATIONS values to try')
+        parser.add_argument(
+            '--samples', type=int, default=3,
+            help='derivations per parameter set, the median latency is reported')
+        parser.add_argument(
+            '--target-ms', type=float, default=250,
+            help='the slowest acceptable single derivation')
+        parser.add_argument(
+            '--memory-budget-mb', type=float, default=512,
+            help='the memory available to concurrent derivations')
+        parser.add_argument(
+            '--concurrency', type=int, default=8,
+            help='how many derivations may run at once')
+
+    def handle(self, *args, **options):
+        self.samples = options['samples']
+        argon2_results = [
+            self._time_argon2(time_cost, memory_cost, parallelism)
+            for time_cost, memory_cost, parallelism in itertools.product(
+                options['time_costs'],
+                options['memory_costs'],
+                options['parallelisms'],
+            )
+            # argon2 needs at least 8 KiB per lane
+            if memory_cost >= 8 * parallelism
+        ]
+        pbkdf2_results = [
+            self._time_pbkdf2(iterations)
+            for iterations in options['iterations']
+        ]
+        memory_budget_kib = options['memory_budget_mb'] * 1024
+        self.stdout.write(json.dumps({
+            'target_ms': options['target_ms'],
+            'memory_budget_mb': options['memory_budget_mb'],
+            'concurrency': options['concurrency'],
+            'argon2': argon2_results,
+            'pbkdf2': pbkdf2_results,
+            'recommended': {
+                **self._recommend_argon2(
+                    argon2_results,
+                    options['target_ms'],
+                    memory_budget_kib / options['concurrency'],
+                ),
+                **self._recommend_pbkdf2(
+                    pbkdf2_results,
+                    options['target_ms'],
+                ),
+            },
+        }, indent=2))
+
+    def _time(self, encode):
+        '''
+        returns the median latency in ms, and the peak python heap use
+        in KiB, of running encode
+        '''
+        latencies = []
+        tracemalloc.start()
+        try:
+            for _ in range(self.samples):
+                start = time.perf_counter()
+                encode()
+                latencies.append((time.perf_counter() - start) * 1000)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return statistics.median(latencies), peak / 1024
+
+    def _time_argon2(self, time_cost, memory_cost, parallelism):
+        hasher = Argon2KeyHasher()
+        hasher.time_cost = time_cost
+        hasher.memory_cost = memory_cost
+        hasher.parallelism = parallelism
+        latency_ms, heap_kib = self._time(
+            lambda: hasher.encode(self.key, self.salt))
+        return {
+            'ARGON2_TIME_COST': time_cost,
+            'ARGON2_MEM_COST': memory_cost,
+            'ARGON2_PARALLELISM': parallelism,
+            'latency_ms': latency_ms,
+            # argon2 allocates memory_cost KiB outside of the python heap
+            'peak_memory_kib': memory_cost + heap_kib,
+        }
+
+    def _time_pbkdf2(self, iterations):
+        hasher = PBKDF2KeyHasher()
+        latency_ms, heap_kib = self._time(
+            lambda: hasher.encode(self.key, self.salt, iterations=iterations))
+        return {
+            'KEY_ITERATIONS': iterations,
+            'latency_ms': latency_ms,
+            'peak_memory_kib': heap_kib,
+        }
+
+    def _recommend_argon2(self, results, target_ms, memory_kib):
+        '''
+        the most memory hard parameters within budget, then the most
+        passes over that memory. measured latency only breaks ties, since
+        a single sample can make a cheaper setting look slower
+        '''
+        candidates = [
+            result for result in results
+            if result['latency_ms'] <= target_ms and
+            result['peak_memory_kib'] <= memory_kib
+        ]
+        if not candidates:
+            return {}
+        best = max(
+            candidates,
+            key=lambda result: (
+                result['ARGON2_MEM_COST'],
+                result['ARGON2_TIME_COST'],
+                result['latency_ms'],
+            ),
+        )
+        return {
+            setting: best[setting]
+            for setting in [
+                'ARGON2_TIME_COST',
+                'ARGON2_MEM_COST',
+                'ARGON2_PARALLELISM',
+            ]
+        }
+
+    def _recommend_pbkdf2(self, results, target_ms):
+        candidates = [
+            result for result in results
+            if result['latency_ms'] <= target_ms
+        ]
+        if not candidates:
+            return {}
+        best = max(candidates, key=lambda result: result['KEY_ITERATIONS'])
+        return {'KEY_ITERATIONS': best['KEY_ITERATIONS']}
@@ -0,0 +1,38 @@
+import json
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+
+from callisto_core.delivery import hashers
+from callisto_core.delivery.models import MatchReport, Report
+
+
+class Command(BaseCommand):
+    help = '''
+        counts the Reports and MatchReports whose keys were stretched with
+        an old hasher or old parameters. these are rekeyed when they're
+        next decrypted. prints the counts as json, by algorithm.
+    '''
+
+    def handle(self, *args, **options):
+        self.stdout.write(json.dumps({
+            'Report': self._count(Report.objects.filter(
+                Q(encode_prefix__isnull=False) | Q(salt__isnull=False))),
+            'MatchReport': self._count(MatchReport.objects.all()),
+        }, indent=2))
+
+    def _count(self, queryset):
+        counts = Counter()
+        # MatchReports in the same epoch share a prefix
+        prefixes = queryset.values('encode_prefix').annotate(
+            rows=Count('pk')).order_by()
+        for prefix in prefixes.iterator():
+            encode_prefix = prefix['encode_prefix']
+            if hashers.must_update(encode_prefix):
+                algorithm = (encode_prefix or 'legacy').split('$', 1)[0]
+                counts[algorithm] += prefix['rows']
+        return {
+            'legacy': sum(counts.values()),
+            'by_algorithm': dict(counts),
+        }
@@ -0,0 +1,24 @@
+from django.db.models import Q
+from django.db.models.query import QuerySet
+
+
+class MatchReportQuerySet(QuerySet):
+
+    def on_site(self, site_id):
+        '''
+        MatchReports entered on this site, plus MatchReports whose owners
+        have no account (and so could not be assigned a site)
+        '''
+        return self.filter(
+            Q(site_id=site_id) | Q(site_id__isnull=True),
+        )
+
+    def in_identifier_domain(self, identifier_domain):
+        '''
+        MatchReports from this identifier domain, plus MatchReports entered
+        before identifier domains were recorded
+        '''
+        return self.filter(
+            Q(identifier_domain=identifier_domain) |
+            Q(identifier_domain__isnull=True),
+        )
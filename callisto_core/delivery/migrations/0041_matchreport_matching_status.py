@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-17 18:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0040_auto_20171215_0302'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matchreport',
+            name='matching_status',
+            field=models.CharField(blank=True, choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], max_length=16),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-17 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0041_matchreport_matching_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matchreport',
+            name='bucket',
+            field=models.CharField(db_index=True, max_length=16, null=True),
+        ),
+    ]
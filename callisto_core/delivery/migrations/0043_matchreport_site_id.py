@@ -0,0 +1,40 @@
+# Generated by Django 2.0.1 on 2026-10-17 19:20
+
+from django.db import migrations, models
+
+
+def backfill_site_id(apps, schema_editor):
+    current_database = schema_editor.connection.alias
+    Account = apps.get_model('accounts.Account')
+    MatchReport = apps.get_model('delivery.MatchReport')
+
+    owners_by_site = {}
+    accounts = Account.objects.using(current_database).values_list(
+        'user_id', 'site_id')
+    for user_id, site_id in accounts:
+        owners_by_site.setdefault(site_id, []).append(user_id)
+
+    for site_id, owner_ids in owners_by_site.items():
+        MatchReport.objects.using(current_database).filter(
+            report__owner_id__in=owner_ids,
+        ).update(site_id=site_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_auto_20180103_1628'),
+        ('delivery', '0042_matchreport_bucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matchreport',
+            name='site_id',
+            field=models.PositiveSmallIntegerField(db_index=True, null=True),
+        ),
+        migrations.RunPython(
+            backfill_site_id,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
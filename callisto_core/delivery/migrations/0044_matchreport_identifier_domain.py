@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-17 19:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0043_matchreport_site_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matchreport',
+            name='identifier_domain',
+            field=models.CharField(db_index=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0044_matchreport_identifier_domain'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='wrapped_key',
+            field=models.BinaryField(null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.0.1 on 2026-10-18 11:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0045_report_wrapped_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WizardSchema',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('serialized', models.TextField()),
+                ('added', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
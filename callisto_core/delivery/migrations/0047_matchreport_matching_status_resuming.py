@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0046_wizardschema'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='matchreport',
+            name='matching_status',
+            field=models.CharField(blank=True, choices=[('pending', 'Pending'), ('running', 'Running'), ('resuming', 'Resuming'), ('done', 'Done'), ('failed', 'Failed')], max_length=16),
+        ),
+    ]
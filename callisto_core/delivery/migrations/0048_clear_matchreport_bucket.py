@@ -0,0 +1,29 @@
+# Generated by Django 2.0.1 on 2026-10-18 16:22
+
+from django.db import migrations
+
+
+def clear_buckets(apps, schema_editor):
+    '''
+    bucket tags are now keyed with a subkey of the pepper, rather than the
+    pepper. unbucketed MatchReports are always trial decrypted, and are
+    given a new bucket the next time they match
+    '''
+    db_alias = schema_editor.connection.alias
+    MatchReport = apps.get_model('delivery', 'MatchReport')
+    MatchReport.objects.using(db_alias).exclude(
+        bucket__isnull=True,
+    ).update(bucket=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('delivery', '0047_matchreport_matching_status_resuming'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            clear_buckets,
+            reverse_code=migrations.RunPython.noop),
+    ]
@@ -3,8 +3,14 @@ import json
 import gnupg
 
 
+def canonical_json(data) -> str:
+    '''json with sorted keys and no whitespace, so equal data is equal text'''
+    return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+
 def gpg_encrypt_data(data, key):
-    data_string = json.dumps(data)
+    # gpg compresses the data before encrypting it
+    data_string = canonical_json(data)
     gpg = gnupg.GPG()
     imported_keys = gpg.import_keys(key)
     encrypted = gpg.encrypt(
@@ -1,5 +1,8 @@
+import functools
+import hashlib
 import json
 import logging
+import time
 import uuid
 
 from nacl.exceptions import CryptoError
@@ -7,9 +10,10 @@ from nacl.exceptions import CryptoError
 from django.conf import settings
 from django.db import models
 from django.utils import timezone
-from django.utils.crypto import get_random_string
+from django.utils.crypto import get_random_string, salted_hmac
+from django.utils.module_loading import import_string
 
-from . import hashers, model_helpers, security, utils
+from . import hashers, managers, model_helpers, security, utils
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +41,9 @@ class Report(models.Model):
     # <algorithm>$<iterations>$<salt>$
     encode_prefix = models.TextField(null=True)
     salt = models.TextField(null=True)  # used for backwards compatibility
+    # the key record data is encrypted with, encrypted with the stretched
+    # passphrase. null for reports encrypted with the stretched passphrase
+    wrapped_key = models.BinaryField(null=True)
 
     # foreign keys
     owner = models.ForeignKey(
@@ -44,6 +51,15 @@ class Report(models.Model):
         on_delete=models.CASCADE,
         null=True)
 
+    # the columns written by encrypt_record
+    encryption_fields = [
+        'encrypted',
+        'encrypted_eval',
+        'wrapped_key',
+        'encode_prefix',
+        'salt',
+    ]
+
     def __str__(self):
         return 'Record(uuid={})'.format(self.uuid)
 
@@ -61,51 +77,158 @@ class Report(models.Model):
         passphrase: str,
     ) -> None:
         '''Encrypts and saves record data, in two formats'''
+        record_data = WizardSchema.compact(record_data)
         self._store_for_user_decryption(record_data, passphrase)
-        self._store_for_callisto_decryption(record_data)
-        self.save()
+        encrypted_eval = self._store_for_callisto_decryption(record_data)
+        self.save_fields(self.encryption_fields)
+        if encrypted_eval:
+            RecordHistorical.objects.create(
+                record=self, encrypted_eval=encrypted_eval)
 
     def decrypt_record(
         self,
         passphrase: str,  # aka secret key aka passphrase
     ) -> dict or str:
         '''decrypts record text from record.encrypted, with the passphrase'''
-        if not (self.encode_prefix or self.salt):
-            key = self.encryption_setup(passphrase)
+        key = self._key_for(passphrase)
+        if self.wrapped_key:
+            data_key = security.unwrap_key(key, self.wrapped_key)
+            record_data_string = security.decrypt_text(
+                data_key, self.encrypted)
         else:
-            _, key = hashers.make_key(
-                self.encode_prefix, passphrase, self.salt)
-
-        record_data_string = security.decrypt_text(key, self.encrypted)
+            data_key = None
+            record_data_string = security.decrypt_text(key, self.encrypted)
+        self._upgrade_encryption(
+            passphrase, key, data_key, record_data_string)
 
         try:
-            decrypted_data = json.loads(record_data_string)
+            decrypted_data = WizardSchema.expand(
+                json.loads(record_data_string))
             return self._return_or_transform(decrypted_data, passphrase)
         except json.decoder.JSONDecodeError:
             logger.info('decrypting legacy report')
             return record_data_string
 
+    def stretched_key(self, passphrase: str) -> hashers.StretchedKey:
+        '''
+        the key for this report, derived from the passphrase. can be
+        passed to decrypt_record and encrypt_record instead of the passphrase
+        '''
+        key = self._key_for(passphrase)
+        return hashers.StretchedKey(key, self.encode_prefix, self.salt)
+
     def withdraw_from_matching(self):
         '''Deletes all associated MatchReports'''
         self.matchreport_set.all().delete()
         self.match_found = False
-        self.save()
+        self.save_fields(['match_found'])
 
     def encryption_setup(self, passphrase):
         '''Generates and stores a random salt'''
-        if self.salt:
-            self.salt = None
-        hasher = hashers.get_hasher()
-        encoded = hasher.encode(passphrase, get_random_string())
-        self.encode_prefix, key = hasher.split_encoded(encoded)
-        self.save()
+        key = self._setup_key(passphrase)
+        self.save_fields(['encode_prefix', 'salt'])
         return key
 
+    def save_fields(self, fields: list):
+        '''
+        saves only the given fields, in a single UPDATE, so that changes
+        to other fields don't rewrite the encrypted columns.
+        new reports are saved in full
+        '''
+        if self._state.adding:
+            self.save()
+        else:
+            self.save(update_fields=fields)
+
     def save(self, *args, **kwargs):
         ''' On save, update timestamps '''
         self.last_edited = timezone.now()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {
+                'last_edited', *kwargs['update_fields']}
         return super().save(*args, **kwargs)
 
+    def _setup_key(self, passphrase):
+        if isinstance(passphrase, hashers.StretchedKey):
+            # the key is only valid with the salt it was derived with
+            return passphrase.key
+        if self.salt:
+            self.salt = None
+        hasher = hashers.get_hasher()
+        self.encode_prefix, key = hashers.derive_key(
+            hasher, passphrase, get_random_string())
+        return key
+
+    def _data_key(self, passphrase):
+        '''
+        the key record data is encrypted with. the key derivation only runs
+        again (with a new salt) for new reports, and when the passphrase was
+        stretched with an old hasher or old parameters
+        '''
+        if not self.wrapped_key:
+            data_key = security.generate_key()
+            self.wrapped_key = security.wrap_key(
+                self._setup_key(passphrase), data_key)
+            return data_key
+
+        data_key = security.unwrap_key(
+            self._key_for(passphrase), self.wrapped_key)
+        if self._must_rekey(passphrase):
+            self.wrapped_key = security.wrap_key(
+                self._setup_key(passphrase), data_key)
+        return data_key
+
+    def _must_rekey(self, passphrase):
+        '''
+        if the passphrase was stretched with an old hasher or old parameters.
+        a stretched key can't be re-stretched, so it's only checked for
+        passphrases
+        '''
+        return (
+            not isinstance(passphrase, hashers.StretchedKey) and
+            hashers.must_update(self.encode_prefix)
+        )
+
+    def _upgrade_encryption(
+        self,
+        passphrase: str,
+        key: bytes,  # the stretched passphrase
+        data_key: bytes or None,
+        record_data_string: str,
+    ):
+        '''
+        after a successful decryption, gives reports from before data keys
+        a data key, and re-stretches passphrases stretched with an old
+        hasher or old parameters. leaves last_edited alone
+        '''
+        if self._must_rekey(passphrase):
+            key = self._setup_key(passphrase)
+            logger.info('rekeyed report with the current hasher')
+        elif self.wrapped_key:
+            return
+
+        if data_key is None:
+            data_key = security.generate_key()
+            self.encrypted = security.encrypt_text(
+                data_key, record_data_string)
+        self.wrapped_key = security.wrap_key(key, data_key)
+        Report.objects.filter(pk=self.pk).update(
+            encrypted=self.encrypted,
+            wrapped_key=self.wrapped_key,
+            encode_prefix=self.encode_prefix,
+            salt=self.salt,
+        )
+
+    def _key_for(self, passphrase):
+        if isinstance(passphrase, hashers.StretchedKey):
+            return passphrase.key
+        elif not (self.encode_prefix or self.salt):
+            return self.encryption_setup(passphrase)
+        else:
+            _, key = hashers.make_key(
+                self.encode_prefix, passphrase, self.salt)
+            return key
+
     def _return_or_transform(
         self,
         data: list or dict,
@@ -132,15 +255,17 @@ class Report(models.Model):
         '''
         store user decryptable data and 500 the request on fails
         '''
-        key = self.encryption_setup(passphrase)
-        self.encrypted = security.encrypt_text(key, json.dumps(record_data))
+        data_key = self._data_key(passphrase)
+        self.encrypted = security.encrypt_text(
+            data_key, model_helpers.canonical_json(record_data))
 
     def _store_for_callisto_decryption(
         self,
         record_data: dict,
     ):
         '''
-        store callisto decryptable data and ignore fails
+        store callisto decryptable data and ignore fails. returns the
+        encrypted data, to be saved to RecordHistorical with the report
         '''
         try:
             encrypted_answers = model_helpers.gpg_encrypt_data(
@@ -148,8 +273,7 @@ class Report(models.Model):
                 key=settings.CALLISTO_EVAL_PUBLIC_KEY,
             )
             self.encrypted_eval = encrypted_answers
-            RecordHistorical.objects.create(
-                record=self, encrypted_eval=encrypted_answers)
+            return encrypted_answers
         except BaseException as error:
             logger.exception(error)
 
@@ -164,14 +288,104 @@ class RecordHistorical(models.Model):
     encrypted_eval = models.BinaryField(null=True)
 
 
+class WizardSchema(models.Model):
+    '''
+    A version of the serialized wizard forms. Records reference their
+    forms by the schema digest, rather than each record (and its eval
+    data, and its history) carrying a copy of every form.
+    '''
+    # records reference a schema via this key, in place of the forms
+    record_key = 'wizard_form_schema'
+
+    # sha256 of the canonical json of the serialized forms
+    digest = models.CharField(max_length=64, unique=True)
+    serialized = models.TextField()
+    added = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def compact(cls, record_data: dict or str) -> dict or str:
+        '''
+        replaces the serialized forms in record data with a reference
+        to their schema, which is created if it doesn't exist yet
+        '''
+        form_key = utils.RecordDataUtil.form_key
+        if not isinstance(record_data, dict) or not record_data.get(form_key):
+            return record_data
+        serialized = model_helpers.canonical_json(record_data[form_key])
+        digest = hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+        cls.objects.get_or_create(
+            digest=digest, defaults={'serialized': serialized})
+
+        compacted = {
+            key: value
+            for key, value in record_data.items()
+            if key != form_key
+        }
+        compacted[cls.record_key] = digest
+        return compacted
+
+    @classmethod
+    def expand(cls, record_data: dict or list) -> dict or list:
+        '''
+        the inverse of compact. record data with the forms inline (from
+        before schemas) is returned as is
+        '''
+        if not isinstance(record_data, dict) or \
+                cls.record_key not in record_data:
+            return record_data
+        expanded = dict(record_data)
+        digest = expanded.pop(cls.record_key)
+        expanded[utils.RecordDataUtil.form_key] = json.loads(
+            cls._serialized_for(digest))
+        return expanded
+
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def _serialized_for(digest: str) -> str:
+        # schemas never change, so they can be cached by digest
+        return WizardSchema.objects.get(digest=digest).serialized
+
+
 class MatchReport(models.Model):
     '''
     A report that indicates the user wants to submit if a match is found.
     A single report can have multiple MatchReports--one per perpetrator.
     '''
+    MATCHING_PENDING = 'pending'
+    MATCHING_RUNNING = 'running'
+    # released by a run of the matching task, for the run that resumes it
+    MATCHING_RESUMING = 'resuming'
+    # waiting on the shards of a ShardedMatchingApi
+    MATCHING_SHARDED = 'sharded'
+    MATCHING_DONE = 'done'
+    MATCHING_FAILED = 'failed'
+    MATCHING_STATUS_CHOICES = (
+        (MATCHING_PENDING, 'Pending'),
+        (MATCHING_RUNNING, 'Running'),
+        (MATCHING_RESUMING, 'Resuming'),
+        (MATCHING_SHARDED, 'Sharded'),
+        (MATCHING_DONE, 'Done'),
+        (MATCHING_FAILED, 'Failed'),
+    )
+
+    objects = managers.MatchReportQuerySet.as_manager()
+
     report = models.ForeignKey(Report, on_delete=models.CASCADE)
     added = models.DateTimeField(auto_now_add=True)
     encrypted = models.BinaryField(null=False)
+    # the site of the report owner's account, used to scope matching
+    site_id = models.PositiveSmallIntegerField(null=True, db_index=True)
+    # the unique_prefix of the identifier's domain, see domain_for
+    identifier_domain = models.CharField(
+        max_length=64, null=True, db_index=True)
+    # keyed coarse tag of the identifier, see security.bucket
+    bucket = models.CharField(max_length=16, null=True, db_index=True)
+    # only set when matching is run in the background
+    matching_status = models.CharField(
+        max_length=16,
+        blank=True,
+        choices=MATCHING_STATUS_CHOICES,
+    )
 
     # <algorithm>$<iterations>$<salt>$
     encode_prefix = models.TextField(blank=True)
@@ -185,56 +399,191 @@ class MatchReport(models.Model):
         self.report.refresh_from_db()
         return self.report.match_found
 
+    @classmethod
+    def epoch_salt(cls, timestamp=None) -> str or None:
+        '''
+        The salt shared by every MatchReport created in the same epoch.
+
+        Sharing a salt means find_matches only has to stretch an
+        identifier once per epoch, instead of once per MatchReport.
+        Returns None if epochs are disabled via
+        settings.CALLISTO_MATCHING_EPOCH_LENGTH
+        '''
+        epoch_length = getattr(
+            settings, 'CALLISTO_MATCHING_EPOCH_LENGTH', 60 * 60 * 24 * 7)
+        if not epoch_length:
+            return None
+        if timestamp is None:
+            timestamp = time.time()
+        epoch = int(timestamp // epoch_length)
+        return salted_hmac(
+            'callisto_core.delivery.models.MatchReport.epoch_salt',
+            f'{epoch_length}:{epoch}',
+        ).hexdigest()[:20]
+
+    @classmethod
+    def domain_for(cls, identifier: str) -> str:
+        '''
+        The identifier domain of a cleaned identifier, which is the
+        unique_prefix from CALLISTO_IDENTIFIER_DOMAINS that
+        MatchIdentifierField prepended to it. Facebook identifiers have
+        an empty prefix, and can't contain colons.
+        '''
+        if ':' in identifier:
+            return identifier.split(':', 1)[0]
+        else:
+            return ''
+
+    @classmethod
+    def bucket_bits(cls) -> int or None:
+        '''
+        settings.CALLISTO_MATCHING_BUCKET_BITS, or else the
+        default_bucket_bits of the matching api (None, unless it's
+        a BucketedMatchingApi)
+        '''
+        from callisto_core.utils.api import MatchingApi
+        if hasattr(settings, 'CALLISTO_MATCHING_BUCKET_BITS'):
+            return settings.CALLISTO_MATCHING_BUCKET_BITS
+        api_class = import_string(getattr(
+            settings,
+            MatchingApi.API_SETTING_NAME,
+            MatchingApi.DEFAULT_CLASS_PATH,
+        ))
+        return getattr(api_class, 'default_bucket_bits', None)
+
+    @classmethod
+    def bucket_for(cls, identifier: str) -> str or None:
+        '''
+        The bucket for new MatchReports with this identifier. Returns None
+        if buckets are disabled, see bucket_bits
+        '''
+        bits = cls.bucket_bits()
+        if not bits:
+            return None
+        return security.bucket(identifier, bits)
+
+    @classmethod
+    def buckets_for(cls, identifier: str) -> list:
+        '''every bucket this identifier could have, for each width'''
+        return [
+            security.bucket(identifier, bits)
+            for bits in range(1, 33)
+        ]
+
+    @property
+    def key_id(self) -> tuple:
+        '''
+        MatchReports with the same key_id are encrypted with the same
+        stretched identifier
+        '''
+        if self.encode_prefix:
+            return (self.encode_prefix, None)
+        else:
+            return (self.encode_prefix, self.salt)
+
     def encrypt_match_report(
         self,
         report_text: str,  # MatchReportContent as a string of json
         identifier: str,  # MatchReport is encrypted with the identifier
     ) -> None:
         '''
-        Encrypts and attaches report text. Generates a random salt and
+        Encrypts and attaches report text. Uses the salt for the current
+        matching epoch (or a random salt if epochs are disabled) and
         stores it in an encode prefix on the MatchReport object.
 
         MatchReports are encrypted with the identifier, whereas Reports
         are encrypted with the secret key
         '''
-        if self.salt:
-            self.salt = None
         hasher = hashers.get_hasher()
-        salt = get_random_string()
-
-        encoded = hasher.encode(identifier, salt)
-        self.encode_prefix, stretched_identifier = hasher.split_encoded(
-            encoded)
+        salt = self.epoch_salt() or get_random_string()
+        encode_prefix, stretched_identifier = hashers.derive_key(
+            hasher, identifier, salt)
+        self.encrypt_match_report_with_key(
+            report_text, identifier, encode_prefix, stretched_identifier)
 
+    def encrypt_match_report_with_key(
+        self,
+        report_text: str,  # MatchReportContent as a string of json
+        identifier: str,
+        encode_prefix: str,
+        stretched_identifier: bytes,  # the identifier, from encode_prefix
+    ) -> None:
+        '''
+        encrypt_match_report, with an identifier that has already been
+        stretched. used to re-encrypt several MatchReports with one stretch
+        '''
+        if self.salt:
+            self.salt = None
+        self.encode_prefix = encode_prefix
         self.encrypted = security.pepper(
             security.encrypt_text(stretched_identifier, report_text),
         )
+        self.bucket = self.bucket_for(identifier)
+        self.identifier_domain = self.domain_for(identifier)
+        self.site_id = self._owner_site_id()
         self.save()
 
-    def get_match(
+    def _owner_site_id(self) -> int or None:
+        try:
+            return self.report.owner.account.site_id
+        except AttributeError:  # no owner, or an owner without an account
+            return None
+
+    def stretch_identifier(
         self,
         identifier: str,  # MatchReport is encrypted with the identifier
-    ) -> str or None:
-        '''
-        Checks if the given identifier triggers a match on this report.
-        Returns report text if so.
-        '''
-        decrypted_report = None
-
+    ) -> bytes:
+        '''runs the key derivation function for this MatchReport'''
         prefix, stretched_identifier = hashers.make_key(
             self.encode_prefix,
             identifier,
             self.salt,
         )
+        return stretched_identifier
+
+    def get_match_with_key(
+        self,
+        stretched_identifier: bytes,  # from stretch_identifier
+        unpeppered: bytes = None,  # self.encrypted, if already unpeppered
+    ) -> str or None:
+        '''
+        Checks if an already stretched identifier triggers a match on
+        this report. Returns report text if so.
+        '''
+        if unpeppered is None:
+            unpeppered = security.unpepper(self.encrypted)
+        decrypted_report = None
         try:
             decrypted_report = security.decrypt_text(
                 stretched_identifier,
-                security.unpepper(self.encrypted),
+                unpeppered,
             )
         except CryptoError:
             pass
         return decrypted_report
 
+    def get_match(
+        self,
+        identifier: str,  # MatchReport is encrypted with the identifier
+    ) -> str or None:
+        '''
+        Checks if the given identifier triggers a match on this report.
+        Returns report text if so.
+        '''
+        return self.get_match_with_key(self.stretch_identifier(identifier))
+
+    def get_match_content(
+        self,
+        identifier: str,  # MatchReport is encrypted with the identifier
+    ) -> str or None:
+        '''
+        The report text for the given identifier. Reuses the text decrypted
+        by find_matches, which is only ever kept in memory on this object,
+        and otherwise falls back to get_match.
+        '''
+        return getattr(self, 'decrypted_report', None) or \
+            self.get_match(identifier)
+
 
 class SentFullReport(models.Model):
     '''Report of a single incident since to the monitoring organization'''
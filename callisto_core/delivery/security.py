@@ -1,7 +1,16 @@
+import zlib
+
 import nacl.secret
 import nacl.utils
 
 from django.conf import settings
+from django.utils.crypto import salted_hmac
+
+# text is encrypted as a payload: PAYLOAD_MAGIC, the payload format
+# version, then the text in that format. text encrypted before payloads
+# is plain utf-8, which never starts with PAYLOAD_MAGIC
+PAYLOAD_MAGIC = b'\x00'
+PAYLOAD_ZLIB = 1
 
 
 def encrypt_text(key, sensitive_text):
@@ -9,13 +18,14 @@ def encrypt_text(key, sensitive_text):
     Encrypts a report using the given secret key.
     Requires a stretched key with a length of 32 bytes.
     The encryption uses PyNacl & Salsa20 stream cipher.
+    The text is compressed into a versioned payload before it's encrypted.
 
     Returns:
       bytes: the encrypted bytes of the sensitive_text
 
     """
     box = nacl.secret.SecretBox(key)
-    message = sensitive_text.encode('utf-8')
+    message = encode_payload(sensitive_text)
     nonce = nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)
     return box.encrypt(message, nonce)
 
@@ -32,8 +42,80 @@ def decrypt_text(key, encrypted_text):
     """
     box = nacl.secret.SecretBox(key)
     # need to force to bytes bc BinaryField can return as memoryview
-    decrypted = box.decrypt(bytes(encrypted_text)).decode('utf-8')
-    return decrypted
+    decrypted = box.decrypt(bytes(encrypted_text))
+    return decode_payload(decrypted)
+
+
+def encode_payload(text):
+    """
+    Compresses text into the current payload format, for encrypt_text.
+
+    Returns:
+      bytes: the magic byte, the format version, then the zlib compressed text
+
+    """
+    return PAYLOAD_MAGIC + bytes([PAYLOAD_ZLIB]) + zlib.compress(
+        text.encode('utf-8'))
+
+
+def decode_payload(payload):
+    """Decodes a payload, or text encrypted before payloads.
+
+    Returns:
+      str: the text in the payload
+
+    Raises:
+      ValueError: If the payload's format version is unknown
+
+    """
+    if payload[:1] != PAYLOAD_MAGIC:
+        return payload.decode('utf-8')
+    version = payload[1]
+    if version == PAYLOAD_ZLIB:
+        return zlib.decompress(payload[2:]).decode('utf-8')
+    else:
+        raise ValueError('unknown payload version {}'.format(version))
+
+
+def generate_key():
+    """
+    Generates a random key, to use with encrypt_text.
+
+    Returns:
+      bytes: a 32 byte key
+
+    """
+    return nacl.utils.random(nacl.secret.SecretBox.KEY_SIZE)
+
+
+def wrap_key(key, data_key):
+    """
+    Encrypts a data key (ex. from generate_key) with a stretched key,
+    so that data encrypted with the data key can be re-keyed without
+    re-encrypting the data.
+
+    Returns:
+      bytes: the encrypted data key
+
+    """
+    box = nacl.secret.SecretBox(key)
+    nonce = nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)
+    return box.encrypt(data_key, nonce)
+
+
+def unwrap_key(key, wrapped_key):
+    """Decrypts a data key encrypted with wrap_key.
+
+    Returns:
+      bytes: the data key
+
+    Raises:
+      CryptoError: In case of a failure to decrypt the wrapped_key
+
+    """
+    box = nacl.secret.SecretBox(key)
+    # need to force to bytes bc BinaryField can return as memoryview
+    return box.decrypt(bytes(wrapped_key))
 
 
 def pepper(encrypted_report):
@@ -80,3 +162,31 @@ def unpepper(peppered_report):
     # need to force to bytes bc BinaryField can return as memoryview
     decrypted = box.decrypt(bytes(peppered_report))
     return decrypted
+
+
+def bucket(identifier, bits):
+    """
+    A short, deliberately collision heavy tag of the identifier, keyed
+    with a subkey of the pepper so that it can't be computed without
+    server access. The pepper itself is only ever used as a SecretBox key.
+
+    Only the first `bits` bits of the HMAC are kept, so every bucket is
+    shared by many identifiers. The width is included in the tag, so
+    that tags of different widths never collide.
+
+    Args:
+      identifier (str): a normalized matching identifier
+      bits (int): the bucket width, between 1 and 32
+
+    Returns:
+      str: the bucket tag, formatted as <bits>:<value>
+
+    """
+    assert 0 < bits <= 32
+    digest = salted_hmac(
+        'callisto.matching.bucket',
+        identifier,
+        secret=settings.PEPPER,
+    ).digest()
+    value = int.from_bytes(digest[:4], 'big') >> (32 - bits)
+    return '{0}:{1}'.format(bits, value)
@@ -7,17 +7,52 @@ docs / reference:
     - https://github.com/project-callisto/callisto-core/blob/master/callisto_core/wizard_builder/view_helpers.py
 
 '''
+import base64
+import copy
+import hashlib
+import json
 import logging
+import threading
 
+from django.conf import settings
 from django.urls import reverse
+from django.utils.crypto import salted_hmac
 
+from callisto_core.delivery import hashers, model_helpers, security
 from callisto_core.wizard_builder import view_helpers as wizard_builder_helpers
 
 logger = logging.getLogger(__name__)
 
+_stats_guard = threading.Lock()
+_stats = {
+    'writes': 0,
+    'skipped_writes': 0,
+}
+
+
+def stats() -> dict:
+    '''
+    totals for every report storage write in this process. writes that
+    wouldn't change the report are skipped
+    '''
+    with _stats_guard:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_guard:
+        _stats.update(writes=0, skipped_writes=0)
+
+
+def _count(stat):
+    with _stats_guard:
+        _stats[stat] += 1
+
 
 class _MockReport:
     uuid = None
+    encode_prefix = None
+    salt = None
 
 
 class ReportStepsHelper(
@@ -37,12 +72,31 @@ class ReportStepsHelper(
 class ReportStorageHelper(
     object,
 ):
+    '''
+    Keeps the passphrase for each report in the session.
+
+    With settings.CALLISTO_SESSION_KEY_STORAGE = 'stretched_key', the
+    stretched key (peppered) is kept instead of the passphrase. The key
+    derivation then only runs when the passphrase is entered, rather than
+    on every decryption.
+
+    Decrypted reports are cached on the request, so a report is decrypted
+    (and its passphrase stretched) at most once per request.
+    '''
 
     def __init__(self, view):
         self.view = view  # TODO: scope down input
 
     @property
-    def passphrase(self) -> str:
+    def stores_stretched_keys(self) -> bool:
+        key_storage = getattr(
+            settings, 'CALLISTO_SESSION_KEY_STORAGE', 'passphrase')
+        return key_storage == 'stretched_key'
+
+    @property
+    def passphrase(self) -> str or hashers.StretchedKey:
+        if self.stores_stretched_keys:
+            return self._stretched_key()
         passphrases = self.view.request.session.get('passphrases', {})
         passphrase = passphrases.get(str(self.report.uuid), '')
         return passphrase
@@ -55,19 +109,116 @@ class ReportStorageHelper(
             return _MockReport
 
     @property
-    def decrypted_report(self) -> dict:
-        return self.report.decrypt_record(self.passphrase)
+    def decrypted_report(self) -> dict or str:
+        '''
+        the report, decrypted with the passphrase in the session. returns
+        a copy, which callers are free to change
+        '''
+        report = self.report
+        entry = self._cache_entry(report)
+        if entry.get('encrypted') != self._encrypted_digest(report):
+            entry['record'] = report.decrypt_record(
+                self._request_key(report, entry))
+            # decrypting can re-encrypt reports in older formats
+            entry['encrypted'] = self._encrypted_digest(report)
+        return copy.deepcopy(entry['record'])
+
+    def encrypt_report(self, record_data: dict):
+        '''report.encrypt_record, with the passphrase in the session'''
+        report = self.report
+        entry = self._cache_entry(report)
+        report.encrypt_record(record_data, self._request_key(report, entry))
+        # the record as decrypt_record would return it
+        entry['record'] = json.loads(json.dumps(record_data))
+        entry['encrypted'] = self._encrypted_digest(report)
 
     def set_passphrase(self, key, report=None):
         if not report:
             report = self.report
+        if self.stores_stretched_keys:
+            self._set_stretched_key(report.stretched_key(key), report)
+            return
         passphrases = self.view.request.session.get('passphrases', {})
         passphrases[str(report.uuid)] = key
         self.view.request.session['passphrases'] = passphrases
 
     def clear_passphrases(self):
-        if self.view.request.session.get('passphrases'):
-            del self.view.request.session['passphrases']
+        for session_key in ['passphrases', 'stretched_keys']:
+            if self.view.request.session.get(session_key):
+                del self.view.request.session[session_key]
+
+    def _cache_entry(self, report) -> dict:
+        '''
+        the request scoped cache for a report and the passphrase in the
+        session. holds the decrypted record, the digest of the encrypted
+        data it was decrypted from, and the stretched passphrase
+        '''
+        request = self.view.request
+        if not hasattr(request, '_callisto_reports'):
+            request._callisto_reports = {}
+        passphrase = self.passphrase
+        if isinstance(passphrase, hashers.StretchedKey):
+            passphrase = passphrase.key
+        credential = salted_hmac(
+            'callisto_core.delivery.view_helpers', passphrase).hexdigest()
+
+        entry = request._callisto_reports.get(report.pk)
+        if not entry or entry['credential'] != credential:
+            entry = request._callisto_reports[report.pk] = {
+                'credential': credential,
+            }
+        return entry
+
+    def _encrypted_digest(self, report) -> str:
+        return hashlib.sha256(bytes(report.encrypted or b'')).hexdigest()
+
+    def _request_key(self, report, entry):
+        '''
+        the passphrase in the session, stretched once per request
+        '''
+        passphrase = self.passphrase
+        if (
+            not passphrase or
+            isinstance(passphrase, hashers.StretchedKey) or
+            not (report.encode_prefix or report.salt) or
+            hashers.must_update(report.encode_prefix)
+        ):
+            # new reports are set up, and reports with old key parameters
+            # are rekeyed, with the passphrase itself
+            return passphrase
+
+        stretched_key = entry.get('key')
+        if not stretched_key or (
+            stretched_key.encode_prefix != report.encode_prefix or
+            stretched_key.salt != report.salt
+        ):
+            stretched_key = entry['key'] = report.stretched_key(passphrase)
+        return stretched_key
+
+    def _stretched_key(self):
+        stretched_keys = self.view.request.session.get('stretched_keys', {})
+        stored = stretched_keys.get(str(self.report.uuid))
+        if not stored:
+            return ''
+        encode_prefix, salt, sealed_key = stored
+        if (
+            encode_prefix != self.report.encode_prefix or
+            salt != self.report.salt
+        ):
+            logger.info('stretched key in session is for an old salt')
+            return ''
+        key = security.unpepper(base64.b64decode(sealed_key))
+        return hashers.StretchedKey(key, encode_prefix, salt)
+
+    def _set_stretched_key(self, stretched_key, report):
+        stretched_keys = self.view.request.session.get('stretched_keys', {})
+        sealed_key = base64.b64encode(security.pepper(stretched_key.key))
+        stretched_keys[str(report.uuid)] = [
+            stretched_key.encode_prefix,
+            stretched_key.salt,
+            sealed_key.decode('utf-8'),
+        ]
+        self.view.request.session['stretched_keys'] = stretched_keys
 
 
 class _LegacyReportStorageHelper(
@@ -83,15 +234,14 @@ class _LegacyReportStorageHelper(
             pass  # storage already initialized
 
     def _report_is_legacy_format(self) -> bool:
-        decrypted_report = self.report.decrypt_record(self.passphrase)
+        decrypted_report = self.decrypted_report
         return bool(not decrypted_report.get(self.storage_form_key, False))
 
     def _create_new_report_storage(self):
-        self.report.encryption_setup(self.passphrase)
         self._create_storage({})
 
     def _translate_legacy_report_storage(self):
-        decrypted_report = self.report.decrypt_record(self.passphrase)
+        decrypted_report = self.decrypted_report
         self._create_storage(decrypted_report[self.storage_data_key])
         logger.debug('translated legacy report storage')
 
@@ -100,7 +250,7 @@ class _LegacyReportStorageHelper(
             self.storage_data_key: data,
             self.storage_form_key: self.serialized_forms,
         }
-        self.report.encrypt_record(storage, self.passphrase)
+        self.encrypt_report(storage)
 
 
 class EncryptedReportStorageHelper(
@@ -120,16 +270,26 @@ class EncryptedReportStorageHelper(
 
     def current_data_from_storage(self) -> dict:
         if self.passphrase:
-            return self.report.decrypt_record(self.passphrase)
+            return self.decrypted_report
         else:
             return self.empty_storage()
 
     def add_data_to_storage(self, data):
         if self.passphrase:
             storage = self.current_data_from_storage()
+            current_storage = self._canonical(storage)
             storage[self.storage_data_key] = data
-            self.report.encrypt_record(storage, self.passphrase)
+            if self._canonical(storage) == current_storage:
+                # ex. a back or next click without any edits
+                _count('skipped_writes')
+                logger.debug('skipped unchanged report storage write')
+                return
+            _count('writes')
+            self.encrypt_report(storage)
 
     def init_storage(self):
         if self.passphrase:
             self._initialize_storage()
+
+    def _canonical(self, storage) -> str:
+        return model_helpers.canonical_json(storage)
@@ -94,7 +94,7 @@ class ReportBasePartial(
 
     @property
     def decrypted_report(self):
-        return self.report.decrypt_record(self.storage.passphrase)
+        return self.storage.decrypted_report
 
     def get_form_kwargs(self):
         # TODO: remove
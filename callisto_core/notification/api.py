@@ -163,7 +163,7 @@ class CallistoCoreNotificationApi(object):
         # TODO: re-evaluate this decision
         # save report timestamp only if generation & email work
         sent_report.report.submitted_to_school = timezone.now()
-        sent_report.report.save()
+        sent_report.report.save_fields(['submitted_to_school'])
 
     def send_student_verification_email(self, form, *args, **kwargs):
         email = form.cleaned_data.get('email')
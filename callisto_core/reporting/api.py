@@ -1,55 +1,334 @@
 import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import ExitStack
+from functools import partial
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max, Min, Q
+
+from callisto_core.delivery import hashers
+
+from . import matching_helpers, metrics
 
 logger = logging.getLogger(__name__)
 
 
 class CallistoCoreMatchingApi(object):
+    # the bucket width used when settings.CALLISTO_MATCHING_BUCKET_BITS
+    # isn't set. None means new MatchReports aren't given a bucket
+    default_bucket_bits = None
+
+    # the columns the matching transforms and match notifications read.
+    # everything else (ex. the encrypted report body) is left in the database
+    match_report_fields = [
+        'report',
+        'added',
+        'encrypted',
+        'encode_prefix',
+        'salt',
+        'bucket',
+        'identifier_domain',
+        'site_id',
+        'report__match_found',
+        'report__contact_email',
+        'report__owner',
+    ]
 
     @property
-    def match_reports(_):
+    def chunk_size(self):
+        return getattr(settings, 'CALLISTO_MATCHING_CHUNK_SIZE', 2000)
+
+    @property
+    def match_reports(self):
         from callisto_core.delivery.models import MatchReport
-        return MatchReport.objects.all()
+        # identifiers from other domains can never decrypt these reports
+        match_reports = MatchReport.objects.in_identifier_domain(
+            MatchReport.domain_for(self.identifier))
+        if getattr(self, 'site_id', None):
+            match_reports = match_reports.on_site(self.site_id)
+        return match_reports
+
+    @property
+    def locking(self):
+        '''
+        How concurrent matching runs are kept from notifying on the same
+        match twice, set via settings.CALLISTO_MATCHING_LOCKING
+
+            'rows': lock the candidate Reports with select_for_update
+            'advisory': take a postgres advisory lock for the identifier
+            None: no locking, matching must run one at a time
+
+        Databases without either kind of lock (ex. sqlite) fall back to
+        a lock shared by the threads of this process.
+        '''
+        return getattr(settings, 'CALLISTO_MATCHING_LOCKING', 'rows')
+
+    @property
+    def lock_id(self):
+        return matching_helpers.lock_id(self.identifier)
+
+    @property
+    def locked_transforms(self):
+        '''
+        the transforms that run under matching_lock. only these read and
+        write match_found, so the rest (ex. trial decryption) run outside
+        of the lock, and outside of its transaction
+        '''
+        return [
+            self._resolve_already_matched_reports,
+            self._update_match_found,
+        ]
+
+    def matching_lock(self):
+        '''
+        runs the locked_transforms in a transaction, so any locks taken
+        by _lock_reports are held until match_found has been updated
+        '''
+        stack = ExitStack()
+        if self.locking:
+            if not self._database_can_lock():
+                stack.enter_context(
+                    matching_helpers.process_lock(self.lock_id))
+            stack.enter_context(transaction.atomic())
+        return stack
+
+    def _database_can_lock(self):
+        if self.locking == 'advisory':
+            return connection.vendor == 'postgresql'
+        else:
+            return connection.features.has_select_for_update
+
+    def _lock_reports(self, match_list):
+        '''
+        locks the Reports in match_list until matching finishes, then
+        returns their current {pk: match_found}. another matching run may
+        have set match_found after match_list was loaded
+        '''
+        from callisto_core.delivery.models import Report
+        reports = Report.objects.filter(
+            pk__in=[match.report_id for match in match_list],
+        ).order_by('pk')
+        if self.locking == 'advisory' and self._database_can_lock():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT pg_advisory_xact_lock(%s)', [self.lock_id])
+        elif self.locking:
+            reports = reports.select_for_update()
+        return dict(reports.values_list('pk', 'match_found'))
+
+    @property
+    def match_reports_for_matching(self):
+        return self._load_for_matching(self.match_reports)
+
+    def _load_for_matching(self, match_reports):
+        return match_reports.select_related(
+            'report__owner',
+        ).only(
+            *self.match_report_fields,
+        )
+
+    @property
+    def candidate_reports(self):
+        '''
+        streams match_reports from the database chunk_size rows at a time,
+        so memory use doesn't grow with the size of the MatchReport table
+        '''
+        return self.match_reports_for_matching.iterator(
+            chunk_size=self.chunk_size)
 
     @property
     def transforms(self):
         return [
             self._resolve_reports_decryptable_with_identifier,
+            self._backfill_identifier_metadata,
+            self._rekey_legacy_reports,
             self._resolve_reports_with_duplicate_owners,
             self._resolve_match_is_between_two_or_more_reports,
             self._resolve_already_matched_reports,
             self._update_match_found,
         ]
 
-    def find_matches(self, identifier):
+    def find_matches(self, identifier, site_id=None):
+        '''
+        if site_id is passed, only MatchReports from that site
+        are considered
+        '''
         self.identifier = identifier
-        match_list = self.match_reports
+        self.site_id = site_id
+        return self._run_transforms(self.transforms, self.candidate_reports)
+
+    def find_matches_in_background(
+        self, identifier, site_id=None, then=None, match_report_id=None,
+    ):
+        '''
+        For apis that match in other celery tasks, so that the task
+        calling this doesn't have to wait on them. Returns True if matching
+        was started, in which case the find_matches signature `then` is
+        called with match_ids= once it finishes, or with local=True if
+        it fails or doesn't finish in time.
 
-        logger.debug(f'all reports => match_reports:{len(match_list)}')
-        for func in self.transforms:
-            if match_list:
-                match_list = func(match_list)
-                logger.debug(f'post {func.__name__} => {match_list}')
+        If match_report_id is passed, its MatchReport must be in the
+        sharded matching_status. the background tasks claim it from there.
+
+        Returns False if the caller should run find_matches itself,
+        which is always the case for apis that match in this process.
+        '''
+        return False
+
+    def find_matches_many(self, identifiers, site_id=None):
+        '''
+        find_matches for several identifiers, reading each candidate
+        MatchReport from the database once. Returns {identifier: matches}
+
+        Trial decryption for all the identifiers runs in a single pass in
+        this process, even for apis that usually trial decrypt elsewhere
+        '''
+        from callisto_core.delivery.models import MatchReport
+        identifiers = list(OrderedDict.fromkeys(identifiers))
+        self.site_id = site_id
+        if not identifiers:
+            return {}
+
+        match_reports = MatchReport.objects.none()
+        for identifier in identifiers:
+            self.identifier = identifier
+            match_reports = match_reports | self.match_reports
+        candidate_reports = self._load_for_matching(match_reports).iterator(
+            chunk_size=self.chunk_size)
+
+        collector = metrics.get_collector()
+        with metrics.measure(collector, 'find_matches_many') as measurements:
+            match_lists = matching_helpers.resolve_decryptable_many(
+                identifiers,
+                metrics.counted(candidate_reports, measurements),
+            )
+            measurements['rows_out'] = sum(
+                len(match_list) for match_list in match_lists.values())
+
+        # trial decryption has already run
+        transforms = [
+            func for func in self.transforms
+            if func != self._resolve_reports_decryptable_with_identifier
+        ]
+        matches = {}
+        for identifier in identifiers:
+            self.identifier = identifier
+            matches[identifier] = self._run_transforms(
+                transforms, match_lists[identifier])
+        return matches
+
+    def _run_transforms(self, transforms, match_list):
+        collector = metrics.get_collector()
+        locked_transforms = self.locked_transforms
+        locked = False
+        with metrics.measure(collector, 'find_matches') as total, \
+                ExitStack() as stack:
+            for func in transforms:
+                if match_list:
+                    # held from the first locked transform to the end
+                    if func in locked_transforms and not locked:
+                        stack.enter_context(self.matching_lock())
+                        locked = True
+                    match_list = self._measured_transform(
+                        collector, func, match_list)
+                    logger.debug(f'post {func.__name__} => {match_list}')
+            total['rows_out'] = len(match_list)
 
         if match_list:
             logger.info(f"matches found => match_reports:{len(match_list)}")
 
         return match_list
 
+    def _measured_transform(self, collector, func, match_list):
+        # the candidate reports are streamed, so they're counted as they're read
+        rows_in = len(match_list) if isinstance(match_list, list) else None
+        with metrics.measure(collector, func.__name__, rows_in) as measurements:
+            if rows_in is None:
+                match_list = metrics.counted(match_list, measurements)
+            match_list = func(match_list)
+            measurements['rows_out'] = len(match_list)
+        return match_list
+
     def _resolve_reports_decryptable_with_identifier(self, match_list):
-        return [
+        return matching_helpers.resolve_decryptable(
+            self.identifier, match_list)
+
+    def _backfill_identifier_metadata(self, match_list):
+        '''
+        sets the bucket and identifier domain of matching MatchReports that
+        don't have them yet (or have a bucket of a different width),
+        now that we know their identifier
+        '''
+        from callisto_core.delivery.models import MatchReport
+        metadata = {
+            'bucket': MatchReport.bucket_for(self.identifier),
+            'identifier_domain': MatchReport.domain_for(self.identifier),
+        }
+        # bucket_for returns None when buckets are disabled
+        metadata = {
+            field: value
+            for field, value in metadata.items()
+            if value is not None
+        }
+        stale_pks = [
+            match_report.pk
+            for match_report in match_list
+            if any(
+                getattr(match_report, field) != value
+                for field, value in metadata.items()
+            )
+        ]
+        if stale_pks:
+            MatchReport.objects.filter(pk__in=stale_pks).update(**metadata)
+            for match_report in match_list:
+                for field, value in metadata.items():
+                    setattr(match_report, field, value)
+            logger.debug(f'backfilled {len(stale_pks)} match reports')
+        return match_list
+
+    def _rekey_legacy_reports(self, match_list):
+        '''
+        re-encrypts matching MatchReports whose identifier was stretched
+        with an old hasher or old parameters, so later matching runs
+        don't pay for the slower key derivation
+        '''
+        from callisto_core.delivery.models import MatchReport
+        legacy_reports = [
             match_report
             for match_report in match_list
-            if match_report.get_match(self.identifier)
+            if hashers.must_update(match_report.encode_prefix)
         ]
+        if not legacy_reports:
+            return match_list
+
+        salt = MatchReport.epoch_salt()
+        if salt:
+            # every rekeyed report shares the epoch salt, so stretch once
+            stretched = hashers.derive_key(
+                hashers.get_hasher(), self.identifier, salt)
+        for match_report in legacy_reports:
+            report_text = match_report.get_match_content(self.identifier)
+            if salt:
+                match_report.encrypt_match_report_with_key(
+                    report_text, self.identifier, *stretched)
+            else:
+                match_report.encrypt_match_report(
+                    report_text, self.identifier)
+        metrics.increment('rekeyed', len(legacy_reports))
+        logger.debug(f'rekeyed {len(legacy_reports)} match reports')
+        return match_list
 
     def _resolve_reports_with_duplicate_owners(self, match_list):
         new_match_list = []
-        report_owners = []
+        report_owner_ids = set()
 
         for match in match_list:
-            if match.report.owner not in report_owners:
+            if match.report.owner_id not in report_owner_ids:
                 new_match_list.append(match)
-                report_owners.append(match.report.owner)
+                report_owner_ids.add(match.report.owner_id)
 
         return new_match_list
 
@@ -60,6 +339,10 @@ class CallistoCoreMatchingApi(object):
             return []
 
     def _resolve_already_matched_reports(self, match_list):
+        match_found = self._lock_reports(match_list)
+        for match_report in match_list:
+            match_report.report.match_found = match_found.get(
+                match_report.report_id, match_report.report.match_found)
         return [
             match_report
             for match_report in match_list
@@ -67,7 +350,300 @@ class CallistoCoreMatchingApi(object):
         ]
 
     def _update_match_found(self, match_list):
+        from callisto_core.delivery.models import Report
+        Report.objects.filter(
+            pk__in=[match.report_id for match in match_list],
+        ).update(match_found=True)
         for match in match_list:
             match.report.match_found = True
-            match.report.save()
         return match_list
+
+
+class BucketedMatchingApi(CallistoCoreMatchingApi):
+    '''
+    Only trial decrypts MatchReports in the same bucket as the identifier,
+    plus MatchReports that have not been assigned a bucket yet
+
+    Bucket width is set via settings.CALLISTO_MATCHING_BUCKET_BITS,
+    and defaults to 6. Narrower buckets mean larger anonymity sets,
+    but more rows to scan.
+
+    Use like:
+        CALLISTO_MATCHING_API = \
+            'callisto_core.reporting.api.BucketedMatchingApi'
+    '''
+    default_bucket_bits = 6
+
+    @property
+    def match_reports(self):
+        from callisto_core.delivery.models import MatchReport
+        return super().match_reports.filter(
+            Q(bucket__in=MatchReport.buckets_for(self.identifier)) |
+            Q(bucket__isnull=True)
+        )
+
+
+class ParallelMatchingApi(CallistoCoreMatchingApi):
+    '''
+    Runs the trial decryption of MatchReports in a process pool. The
+    identifier is stretched once per key_id (spread over the pool when
+    there are several, ex. legacy salts), then the rows are split evenly
+    between the workers and trial decrypted with those keys.
+
+    The pool size is set via settings.CALLISTO_MATCHING_WORKERS,
+    and defaults to the cpu count
+
+    Use like:
+        CALLISTO_MATCHING_API = \
+            'callisto_core.reporting.api.ParallelMatchingApi'
+    '''
+
+    @property
+    def workers(self):
+        return getattr(
+            settings, 'CALLISTO_MATCHING_WORKERS', None) or os.cpu_count()
+
+    def _resolve_reports_decryptable_with_identifier(self, match_list):
+        match_reports = OrderedDict(
+            (match_report.pk, match_report)
+            for match_report in match_list
+        )
+        # the identifier is stretched once per key_id, rather than per row.
+        # MatchReports from the same epoch share a key_id
+        key_ids = list(OrderedDict.fromkeys(
+            match_report.key_id
+            for match_report in match_reports.values()
+        ))
+        stretched_identifiers = dict(zip(key_ids, self._map_chunks(
+            partial(matching_helpers.stretch_key_ids, self.identifier),
+            key_ids,
+        )))
+        metrics.increment('kdf_calls', len(key_ids))
+
+        rows = [
+            (
+                pk,
+                stretched_identifiers[match_report.key_id],
+                # BinaryField can return as memoryview, which can't pickle
+                bytes(match_report.encrypted),
+            )
+            for pk, match_report in match_reports.items()
+        ]
+        decrypted_reports = dict(
+            self._map_chunks(matching_helpers.decrypt_rows, rows))
+        metrics.increment(
+            'decrypt_failures', len(rows) - len(decrypted_reports))
+
+        for pk, decrypted_report in decrypted_reports.items():
+            match_reports[pk].decrypted_report = decrypted_report
+        return [
+            match_report
+            for pk, match_report in match_reports.items()
+            if pk in decrypted_reports
+        ]
+
+    def _map_chunks(self, func, items):
+        '''
+        runs func over items split into a chunk per worker, and returns
+        the results in order. a single chunk runs in this process
+        '''
+        chunks = matching_helpers.split_evenly(items, self.workers)
+        if len(chunks) <= 1:
+            return func(items)
+        pool = matching_helpers.get_process_pool(self.workers)
+        results = []
+        for result in pool.map(func, chunks):
+            results.extend(result)
+        return results
+
+
+class ShardedMatchingApi(CallistoCoreMatchingApi):
+    '''
+    Splits the MatchReport pk range into shards, and trial decrypts
+    each shard in a celery task, so matching can run on many nodes.
+    The rest of the transforms run centrally on the matched pks.
+
+    Shards only return pks, so that report text is never stored in the
+    celery result backend.
+
+    From the find_matches task, the shards are dispatched as a chord,
+    whose callback (the finish_sharded_matching task) runs the rest of
+    the transforms, so no worker sits waiting on its shards. Called
+    directly, find_matches waits for the shards, unless it is called from
+    inside a celery worker, in which case it trial decrypts locally.
+
+    Shards that fail, or run for longer than
+    settings.CALLISTO_MATCHING_SHARD_TIMEOUT seconds, are re-run
+    locally. The shard count is set via settings.CALLISTO_MATCHING_SHARDS
+
+    In the background, shards that don't start within the shard timeout
+    expire and fail the chord. If the chord fails, or hasn't finished
+    within settings.CALLISTO_MATCHING_DEADLINE seconds, find_matches is
+    resumed to match locally.
+
+    Use like:
+        CALLISTO_MATCHING_API = \
+            'callisto_core.reporting.api.ShardedMatchingApi'
+    '''
+
+    @property
+    def shard_count(self):
+        return getattr(settings, 'CALLISTO_MATCHING_SHARDS', 8)
+
+    @property
+    def shard_timeout(self):
+        return getattr(settings, 'CALLISTO_MATCHING_SHARD_TIMEOUT', 300)
+
+    @property
+    def deadline(self):
+        '''
+        seconds for background matching to finish in, before the
+        MatchReport is matched locally instead
+        '''
+        return getattr(
+            settings, 'CALLISTO_MATCHING_DEADLINE', 3 * self.shard_timeout)
+
+    @property
+    def api_path(self):
+        return f'{type(self).__module__}.{type(self).__qualname__}'
+
+    @property
+    def shards(self):
+        # the shards query the MatchReports themselves
+        pk_range = self.match_reports.aggregate(Min('pk'), Max('pk'))
+        if pk_range['pk__min'] is None:
+            return []
+        return matching_helpers.split_pk_range(
+            pk_range['pk__min'], pk_range['pk__max'], self.shard_count)
+
+    def trial_decrypt_shard(self, pk_start, pk_end):
+        '''
+        returns the pks of the MatchReports in [pk_start, pk_end)
+        that decrypt with the identifier
+        '''
+        match_reports = self.match_reports_for_matching.filter(
+            pk__gte=pk_start,
+            pk__lt=pk_end,
+        ).iterator(chunk_size=self.chunk_size)
+        return [
+            match_report.pk
+            for match_report in matching_helpers.resolve_decryptable(
+                self.identifier, match_reports)
+        ]
+
+    def find_matches_in_background(
+        self, identifier, site_id=None, then=None, match_report_id=None,
+    ):
+        from celery import chord
+        from callisto_core.celeryconfig import tasks
+        self.identifier = identifier
+        self.site_id = site_id
+        shards = self.shards
+        if not shards:
+            return False
+
+        sealed_identifier = matching_helpers.seal_identifier(identifier)
+        try:
+            finish = tasks.finish_sharded_matching.s(
+                self.api_path, sealed_identifier, site_id, shards,
+                then=then, match_report_id=match_report_id,
+            )
+            if match_report_id and then:
+                finish.on_error(tasks.sharded_matching_failed.s(
+                    match_report_id, then))
+            chord(
+                tasks.trial_decrypt_shard.signature(
+                    (self.api_path, sealed_identifier, site_id, *shard),
+                    # shards that don't start in time fail the chord
+                    expires=self.shard_timeout,
+                    soft_time_limit=self.shard_timeout,
+                    immutable=True,
+                )
+                for shard in shards
+            )(finish)
+        except Exception:
+            logger.exception('could not dispatch the matching shards')
+            return False
+
+        if match_report_id and then:
+            # for shards that are lost, or a chord that never finishes
+            try:
+                tasks.rematch_locally.apply_async(
+                    (match_report_id, then), countdown=self.deadline)
+            except Exception:
+                logger.exception('could not schedule the matching deadline')
+        return True
+
+    def finish_sharded_matching(self, identifier, site_id, shards, results):
+        '''
+        runs the rest of find_matches once the shards have finished.
+        results are the pks each shard matched, or None for failed shards
+        '''
+        self.identifier = identifier
+        self.site_id = site_id
+        transforms = [
+            func for func in self.transforms
+            if func != self._resolve_reports_decryptable_with_identifier
+        ]
+        return self._run_transforms(
+            transforms, self._matched_reports(shards, results))
+
+    def _resolve_reports_decryptable_with_identifier(self, match_list):
+        from celery import current_task
+        shards = self.shards
+        if not shards:
+            return []
+
+        if current_task and not current_task.request.is_eager:
+            logger.warning(
+                'trial decrypting locally, rather than waiting on shards '
+                'from inside a celery worker. use find_matches_in_background')
+            results = [None] * len(shards)
+        else:
+            results = self._gather_shards(
+                shards, self._dispatch_shards(shards))
+        return self._matched_reports(shards, results)
+
+    def _matched_reports(self, shards, results):
+        matched_pks = set()
+        for shard, pks in zip(shards, results):
+            if pks is None:
+                logger.warning(f're-running matching shard {shard} locally')
+                pks = self.trial_decrypt_shard(*shard)
+            matched_pks.update(pks)
+
+        match_reports = self.match_reports_for_matching.in_bulk(matched_pks)
+        return [
+            match_reports[pk]
+            for pk in sorted(match_reports)
+        ]
+
+    def _dispatch_shards(self, shards):
+        '''the AsyncResult for each shard, or None if it wasn't dispatched'''
+        from callisto_core.celeryconfig import tasks
+        sealed_identifier = matching_helpers.seal_identifier(self.identifier)
+        results = []
+        for shard in shards:
+            try:
+                results.append(tasks.trial_decrypt_shard.delay(
+                    self.api_path, sealed_identifier, self.site_id, *shard))
+            except Exception:
+                logger.exception(f'could not dispatch matching shard {shard}')
+                results.append(None)
+        return results
+
+    def _gather_shards(self, shards, results):
+        '''the pks each shard matched, or None if it failed'''
+        deadline = time.monotonic() + self.shard_timeout
+        matched_pks = []
+        for shard, result in zip(shards, results):
+            if result is None:
+                matched_pks.append(None)
+                continue
+            try:
+                matched_pks.append(result.get(
+                    timeout=max(deadline - time.monotonic(), 0)))
+            except Exception:
+                logger.exception(f'matching shard {shard} failed')
+                matched_pks.append(None)
+        return matched_pks
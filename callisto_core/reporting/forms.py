@@ -47,6 +47,12 @@ class PrepForm(
         required=False,
     )
 
+    def save(self, commit=True):
+        report = super().save(commit=False)
+        if commit:
+            report.save_fields(self._meta.fields)
+        return report
+
     class Meta:
         model = delivery_models.Report
         fields = [
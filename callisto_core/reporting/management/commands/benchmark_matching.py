@@ -0,0 +1,183 @@
+import json
+import statistics
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+from django.utils.crypto import get_random_string
+from django.utils.module_loading import import_string
+
+from callisto_core import __version__
+from callisto_core.delivery import hashers, security
+from callisto_core.delivery.models import MatchReport, Report
+from callisto_core.reporting.metrics import InMemoryMatchingMetrics
+from callisto_core.reporting.report_delivery import MatchReportContent
+
+User = get_user_model()
+
+HASHER_PATHS = {
+    'argon2': 'callisto_core.delivery.hashers.Argon2KeyHasher',
+    'pbkdf2': 'callisto_core.delivery.hashers.PBKDF2KeyHasher',
+}
+ROW_KINDS = ['argon2', 'pbkdf2', 'legacy']
+HIT_IDENTIFIER = 'benchmark-hit'
+MISS_IDENTIFIER = 'benchmark-miss'
+
+
+class Command(BaseCommand):
+    help = '''
+        times find_matches against synthetic MatchReports, and prints the
+        results as json. all seeded data is rolled back afterwards.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', nargs='+', type=int, default=[10, 100, 1000],
+            help='the MatchReport counts to time find_matches at')
+        parser.add_argument(
+            '--repeat', type=int, default=3,
+            help='find_matches runs per case, the median is reported')
+        parser.add_argument(
+            '--api', default='callisto_core.reporting.api.CallistoCoreMatchingApi',
+            help='the matching api class to benchmark')
+        parser.add_argument(
+            '--random-salts', action='store_true',
+            help='seed with a random salt per MatchReport, instead of the epoch salt')
+        parser.add_argument(
+            '--output',
+            help='also write the results to this file')
+
+    def handle(self, *args, **options):
+        self.api = import_string(options['api'])()
+        self.random_salts = options['random_salts']
+
+        with transaction.atomic():
+            results = self._benchmark(
+                sorted(options['sizes']), options['repeat'])
+            transaction.set_rollback(True)
+
+        output = json.dumps({
+            'version': __version__,
+            'api': options['api'],
+            'random_salts': self.random_salts,
+            'settings': self._kdf_settings(),
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output)
+        self.stdout.write(output)
+
+    def _kdf_settings(self):
+        return {
+            setting: getattr(settings, setting, None)
+            for setting in [
+                'KEY_HASHERS',
+                'ARGON2_TIME_COST',
+                'ARGON2_MEM_COST',
+                'ARGON2_PARALLELISM',
+                'KEY_ITERATIONS',
+                'ORIGINAL_KEY_ITERATIONS',
+                'CALLISTO_MATCHING_EPOCH_LENGTH',
+            ]
+        }
+
+    def _benchmark(self, sizes, repeat):
+        self.seeded = 0
+        results = []
+        # one hit per row kind, each from a different owner
+        for kind in ROW_KINDS:
+            self._seed_row(kind, HIT_IDENTIFIER)
+        for size in sizes:
+            self._seed_up_to(size)
+            for case, identifier in [
+                ('hit', HIT_IDENTIFIER),
+                ('miss', MISS_IDENTIFIER),
+            ]:
+                results.append(self._time_case(size, case, identifier, repeat))
+        return results
+
+    def _seed_up_to(self, size):
+        for index in range(self.seeded, size):
+            self._seed_row(
+                ROW_KINDS[index % len(ROW_KINDS)],
+                f'benchmark-{index}',
+            )
+
+    def _seed_row(self, kind, identifier):
+        self.seeded += 1
+        owner = User.objects.create(
+            username=f'benchmark-{get_random_string()}')
+        match_report = MatchReport(report=Report.objects.create(owner=owner))
+        report_text = json.dumps(MatchReportContent(
+            identifier=identifier, perp_name=identifier,
+            email='benchmark@example.com', phone='',
+        ).__dict__)
+
+        if kind == 'legacy':
+            self._encrypt_legacy(match_report, identifier, report_text)
+        else:
+            with override_settings(
+                KEY_HASHERS=[HASHER_PATHS[kind]],
+                **self._epoch_settings()
+            ):
+                match_report.encrypt_match_report(report_text, identifier)
+
+    def _epoch_settings(self):
+        if self.random_salts:
+            return {'CALLISTO_MATCHING_EPOCH_LENGTH': None}
+        else:
+            return {}
+
+    def _encrypt_legacy(self, match_report, identifier, report_text):
+        '''
+        encrypts a MatchReport the way MatchReports were encrypted
+        before encode prefixes, with a per row salt
+        '''
+        match_report.encode_prefix = ''
+        match_report.salt = get_random_string()
+        _, stretched_identifier = hashers.make_key(
+            match_report.encode_prefix, identifier, match_report.salt)
+        match_report.encrypted = security.pepper(
+            security.encrypt_text(stretched_identifier, report_text))
+        match_report.save()
+
+    @override_settings(
+        CALLISTO_MATCHING_METRICS='callisto_core.reporting.metrics.InMemoryMatchingMetrics',
+    )
+    def _time_case(self, size, case, identifier, repeat):
+        runs = []
+        for _ in range(repeat):
+            InMemoryMatchingMetrics.reset()
+            # every run starts from the seeded rows, rather than from
+            # rows the last run matched or rekeyed
+            with transaction.atomic():
+                self.api.find_matches(identifier)
+                transaction.set_rollback(True)
+            runs.append(dict(InMemoryMatchingMetrics.records))
+
+        seconds = statistics.median(
+            run['find_matches']['seconds'] for run in runs)
+        return {
+            'rows': size,
+            'case': case,
+            'matches': runs[-1]['find_matches']['rows_out'],
+            'seconds': seconds,
+            'rows_per_second': size / seconds if seconds else None,
+            'stages': {
+                stage: self._median_measurements(runs, stage)
+                for stage in runs[-1]
+                if stage != 'find_matches'
+            },
+        }
+
+    def _median_measurements(self, runs, stage):
+        measurements = [run[stage] for run in runs if stage in run]
+        return {
+            name: statistics.median(
+                measurement[name] for measurement in measurements)
+            for name, value in measurements[-1].items()
+            if value is not None
+        }
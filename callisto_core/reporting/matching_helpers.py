@@ -0,0 +1,333 @@
+'''
+
+Matching helpers contain functionality shared between the matching api
+implementations. They may run outside of the web process (ex. in a
+process pool), so they should not depend on any request state.
+
+'''
+import base64
+import inspect
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+from callisto_core.delivery import security
+from callisto_core.utils.api import (
+    MatchingApi, NotificationApi, TenantApi,
+)
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_process_pools = {}
+_process_locks = {}
+_process_locks_guard = threading.Lock()
+
+
+def find_matches(identifier, site_id=None):
+    '''
+    MatchingApi.find_matches, scoped to site_id. site_id is only passed
+    when it's set, and only to apis whose find_matches takes it, so
+    apis written before matching was scoped to a site
+    (ex. find_matches(self, identifier)) keep working, unscoped.
+    '''
+    api_find_matches = MatchingApi.find_matches
+    if site_id is None:
+        return api_find_matches(identifier)
+    if 'site_id' in inspect.signature(api_find_matches).parameters:
+        return api_find_matches(identifier, site_id=site_id)
+    logger.warning(
+        'MatchingApi.find_matches does not take a site_id, '
+        'so matching is not scoped to a site')
+    return api_find_matches(identifier)
+
+
+def resolve_decryptable(identifier, match_reports):
+    '''
+    Returns the MatchReports that decrypt with the identifier, with their
+    decrypted text set on MatchReport.decrypted_report
+
+    The identifier is stretched once per MatchReport.key_id, so
+    MatchReports from the same epoch share a single key derivation.
+    '''
+    stretched_identifiers = {}
+    matches = []
+
+    for match_report in match_reports:
+        key_id = match_report.key_id
+        if key_id not in stretched_identifiers:
+            stretched_identifiers[key_id] = \
+                match_report.stretch_identifier(identifier)
+            metrics.increment('kdf_calls')
+        decrypted_report = match_report.get_match_with_key(
+            stretched_identifiers[key_id])
+        if decrypted_report:
+            match_report.decrypted_report = decrypted_report
+            matches.append(match_report)
+        else:
+            metrics.increment('decrypt_failures')
+
+    logger.debug(f'stretched identifier {len(stretched_identifiers)} times')
+    return matches
+
+
+def resolve_decryptable_many(identifiers, match_reports):
+    '''
+    resolve_decryptable for several identifiers, in one pass over
+    match_reports. Each MatchReport is unpeppered once, then tried against
+    every identifier from its identifier domain.
+
+    Returns {identifier: [MatchReports that decrypt with it]}
+    '''
+    from callisto_core.delivery.models import MatchReport
+    identifier_domains = {
+        identifier: MatchReport.domain_for(identifier)
+        for identifier in identifiers
+    }
+    stretched_identifiers = {}
+    matches = {identifier: [] for identifier in identifiers}
+
+    for match_report in match_reports:
+        unpeppered = security.unpepper(match_report.encrypted)
+        for identifier, identifier_domain in identifier_domains.items():
+            if match_report.identifier_domain not in (None, identifier_domain):
+                continue
+            key_id = (identifier, match_report.key_id)
+            if key_id not in stretched_identifiers:
+                stretched_identifiers[key_id] = \
+                    match_report.stretch_identifier(identifier)
+                metrics.increment('kdf_calls')
+            decrypted_report = match_report.get_match_with_key(
+                stretched_identifiers[key_id], unpeppered)
+            if decrypted_report:
+                match_report.decrypted_report = decrypted_report
+                matches[identifier].append(match_report)
+                # only one identifier can decrypt a MatchReport
+                break
+            else:
+                metrics.increment('decrypt_failures')
+
+    logger.debug(f'stretched identifiers {len(stretched_identifiers)} times')
+    return matches
+
+
+def stretch_key_ids(identifier, key_ids):
+    '''
+    Process pool entrypoint.
+
+    Takes MatchReport.key_id tuples, and returns the identifier
+    stretched for each of them, in the same order.
+    '''
+    from callisto_core.delivery.models import MatchReport
+    return [
+        MatchReport(
+            encode_prefix=encode_prefix,
+            salt=salt,
+        ).stretch_identifier(identifier)
+        for encode_prefix, salt in key_ids
+    ]
+
+
+def decrypt_rows(rows):
+    '''
+    Process pool entrypoint.
+
+    Takes (pk, stretched identifier, encrypted) tuples and returns
+    (pk, decrypted report text) tuples for the rows that decrypt.
+    '''
+    from callisto_core.delivery.models import MatchReport
+    decrypted_rows = []
+    for pk, stretched_identifier, encrypted in rows:
+        decrypted_report = MatchReport(encrypted=encrypted).get_match_with_key(
+            stretched_identifier)
+        if decrypted_report:
+            decrypted_rows.append((pk, decrypted_report))
+    return decrypted_rows
+
+
+def split_evenly(items, chunk_count):
+    '''
+    Splits items into at most chunk_count contiguous chunks of
+    (roughly) equal size
+    '''
+    if not items:
+        return []
+    chunk_size = -(-len(items) // chunk_count)
+    return [
+        items[start:start + chunk_size]
+        for start in range(0, len(items), chunk_size)
+    ]
+
+
+def split_pk_range(min_pk, max_pk, shard_count):
+    '''
+    Splits the pks from min_pk to max_pk (inclusive) into at most
+    shard_count (start, end) ranges. Ranges include start and
+    exclude end.
+    '''
+    pk_count = max_pk - min_pk + 1
+    shard_count = max(1, min(shard_count, pk_count))
+    bounds = [
+        min_pk + pk_count * shard // shard_count
+        for shard in range(shard_count + 1)
+    ]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def get_process_pool(workers):
+    '''
+    lazily creates one process pool per worker count, per process.
+    pools are keyed on the pid because they don't survive a fork
+    '''
+    pool_id = (os.getpid(), workers)
+    if pool_id not in _process_pools:
+        _process_pools[pool_id] = ProcessPoolExecutor(max_workers=workers)
+    return _process_pools[pool_id]
+
+
+def lock_id(identifier: str) -> int:
+    '''
+    a 32 bit lock id for the identifier. derived from a keyed hash,
+    so lock ids don't reveal the identifier
+    '''
+    return int(security.bucket(identifier, 32).split(':')[1])
+
+
+@contextmanager
+def process_lock(lock_id: int):
+    '''
+    Holds a lock for lock_id, shared by every thread in this process.
+    For databases without row locks or advisory locks (ex. sqlite),
+    where this is the only thing keeping matching runs apart.
+    '''
+    with _process_locks_guard:
+        lock = _process_locks.setdefault(lock_id, threading.Lock())
+    with lock:
+        yield
+
+
+def seal_identifier(identifier: str) -> str:
+    '''
+    encrypts an identifier with the pepper, so that it can be passed
+    through the task broker without being stored in plain text
+    '''
+    sealed = security.pepper(identifier.encode('utf-8'))
+    return base64.b64encode(sealed).decode('utf-8')
+
+
+def unseal_identifier(sealed_identifier: str) -> str:
+    '''decrypts an identifier sealed with seal_identifier'''
+    sealed = base64.b64decode(sealed_identifier)
+    return security.unpepper(sealed).decode('utf-8')
+
+
+class MatchNotificationHelper(object):
+    '''
+    Sends the notifications for a matching run. Used both by the matching
+    view partials and the background matching task, so it only depends
+    on the site id rather than on a request.
+    '''
+
+    def __init__(
+        self,
+        report,
+        site_id,
+        admin_email_template_name,
+        coordinator_emails=None,
+        coordinator_public_key=None,
+    ):
+        self.report = report
+        self.site_id = site_id
+        self.admin_email_template_name = admin_email_template_name
+        self.coordinator_emails = coordinator_emails or \
+            TenantApi.site_settings('COORDINATOR_EMAIL', site_id=site_id)
+        self.coordinator_public_key = coordinator_public_key or \
+            TenantApi.site_settings('COORDINATOR_PUBLIC_KEY', site_id=site_id)
+
+    def notify(self, matches, identifier, notified=None):
+        '''
+        Sends each notification that isn't in notified yet, adding its
+        name to notified once it has been sent. Passing the same notified
+        back in (ex. on retry) only sends the notifications that didn't
+        go out the first time.
+        '''
+        if notified is None:
+            notified = set()
+        for name, send in self.notifications(matches, identifier):
+            if name not in notified:
+                send()
+                notified.add(name)
+        return notified
+
+    def notifications(self, matches, identifier):
+        '''(name, send) for every notification, in the order they're sent'''
+        notifications = [(
+            'owner_of_submission',
+            partial(self.notify_owner_of_submission, identifier),
+        )]
+        if matches:
+            notifications.append((
+                'authority_of_matches',
+                partial(self.notify_authority_of_matches, matches, identifier),
+            ))
+            notifications.extend(
+                (
+                    f'owner_of_match:{match.pk}',
+                    partial(self.notify_owner_of_match, match),
+                )
+                for match in matches
+            )
+            notifications.append((
+                'slack',
+                self.slack_match_notification,
+            ))
+            notifications.append((
+                'callisto_team',
+                partial(self.match_confirmation_email_to_callisto, matches),
+            ))
+        return notifications
+
+    def slack_match_notification(self):
+        NotificationApi.slack_notification(
+            msg='New Callisto Matches (details will be sent via email)',
+            type='match_confirmation',
+        )
+
+    def match_confirmation_email_to_callisto(self, matches):
+        NotificationApi.send_with_kwargs(
+            site_id=self.site_id,  # required in general
+            email_template_name=self.admin_email_template_name,  # the email template
+            to_addresses=NotificationApi.ALERT_LIST,  # addresses to send to
+            matches=matches,  # used in the email body
+            email_subject='New Callisto Matches',  # rendered as the email subject
+            email_name='match_confirmation_callisto_team',  # used in test assertions
+        )
+
+    def notify_owner_of_submission(self, identifier):
+        if identifier:
+            NotificationApi.send_confirmation(
+                email_type='match_confirmation',
+                to_addresses=[self.report.contact_email],
+                site_id=self.site_id,
+            )
+
+    def notify_authority_of_matches(self, matches, identifier):
+        NotificationApi.send_matching_report_to_authority(
+            matches=matches,
+            identifier=identifier,
+            to_addresses=self.coordinator_emails,
+            public_key=self.coordinator_public_key,
+        )
+
+    def notify_owners_of_matches(self, matches):
+        for match in matches:
+            self.notify_owner_of_match(match)
+
+    def notify_owner_of_match(self, match):
+        NotificationApi.send_match_notification(
+            match_report=match,
+        )
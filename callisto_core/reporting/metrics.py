@@ -0,0 +1,165 @@
+'''
+
+Instrumentation for the matching transforms. Each transform run is
+measured, and the measurements are passed to the collector set via
+settings.CALLISTO_MATCHING_METRICS. The default collector (MatchingMetrics)
+discards them.
+
+Measurements are:
+    seconds: wall time
+    rows_in / rows_out: MatchReports passed into / out of the transform
+    kdf_calls: identifier stretches
+    decrypt_failures: MatchReports that did not decrypt
+    rekeyed: MatchReports re-encrypted with the current hasher
+    queries: database queries
+
+kdf_calls and decrypt_failures are only counted for work done in the
+current process, so they don't include work done in a process pool
+or on other celery workers.
+
+'''
+import logging
+import socket
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def get_collector():
+    collector_path = getattr(
+        settings,
+        'CALLISTO_MATCHING_METRICS',
+        'callisto_core.reporting.metrics.MatchingMetrics',
+    )
+    return import_string(collector_path)()
+
+
+def increment(name: str, value=1):
+    '''adds to a counter for every stage currently being measured'''
+    for counters in getattr(_local, 'counters', []):
+        counters[name] += value
+
+
+@contextmanager
+def measure(collector, stage: str, rows_in=None):
+    '''
+    Measures the code in the with block, and records it with the collector.
+    The yielded dict can be updated with measurements only known
+    at the end of the block (ex. rows_out)
+    '''
+    counters = Counter()
+    measurements = {'rows_in': rows_in}
+    stack = getattr(_local, 'counters', [])
+    _local.counters = stack + [counters]
+
+    def count_query(execute, sql, params, many, context):
+        counters['queries'] += 1
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(count_query):
+            yield measurements
+    finally:
+        _local.counters = stack
+        measurements['seconds'] = time.perf_counter() - start
+        measurements.update({
+            'kdf_calls': counters['kdf_calls'],
+            'decrypt_failures': counters['decrypt_failures'],
+            'rekeyed': counters['rekeyed'],
+            'queries': counters['queries'],
+        })
+        try:
+            collector.record(stage, measurements)
+        except Exception:
+            logger.exception(f'could not record metrics for {stage}')
+
+
+def counted(rows, measurements, key='rows_in'):
+    '''
+    yields from rows, counting them into measurements[key].
+    used for iterators, which can't be counted up front
+    '''
+    measurements[key] = 0
+    for row in rows:
+        measurements[key] += 1
+        yield row
+
+
+class MatchingMetrics(object):
+    '''discards every measurement. subclass and override record to keep them'''
+
+    def record(self, stage: str, measurements: dict):
+        pass
+
+
+class LoggingMatchingMetrics(MatchingMetrics):
+
+    def record(self, stage, measurements):
+        values = ' '.join(
+            f'{name}={value}'
+            for name, value in sorted(measurements.items())
+        )
+        logger.info(f'matching.{stage} {values}')
+
+
+class StatsdMatchingMetrics(MatchingMetrics):
+    '''
+    Sends measurements to statsd over udp. Configured with
+    settings.CALLISTO_STATSD_HOST, CALLISTO_STATSD_PORT,
+    and CALLISTO_STATSD_PREFIX
+    '''
+
+    @property
+    def address(self):
+        return (
+            getattr(settings, 'CALLISTO_STATSD_HOST', 'localhost'),
+            getattr(settings, 'CALLISTO_STATSD_PORT', 8125),
+        )
+
+    @property
+    def prefix(self):
+        return getattr(settings, 'CALLISTO_STATSD_PREFIX', 'callisto.matching')
+
+    def lines(self, stage, measurements):
+        for name, value in sorted(measurements.items()):
+            if value is None:
+                continue
+            elif name == 'seconds':
+                yield f'{self.prefix}.{stage}.ms:{value * 1000:.3f}|ms'
+            else:
+                yield f'{self.prefix}.{stage}.{name}:{value}|c'
+
+    def record(self, stage, measurements):
+        packet = '\n'.join(self.lines(stage, measurements)).encode('utf-8')
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(packet, self.address)
+
+
+class InMemoryMatchingMetrics(MatchingMetrics):
+    '''keeps every measurement in memory, for tests and benchmarks'''
+    records = []
+
+    @classmethod
+    def reset(cls):
+        cls.records.clear()
+
+    @classmethod
+    def for_stage(cls, stage):
+        return [
+            measurements
+            for recorded_stage, measurements in cls.records
+            if recorded_stage == stage
+        ]
+
+    def record(self, stage, measurements):
+        self.records.append((stage, dict(measurements)))
@@ -339,7 +339,7 @@ class PDFMatchReport(PDFReport):
         matches_with_reports = [
             (match,
              MatchReportContent(
-                 **json.loads(match.get_match(self.identifier))))
+                 **json.loads(match.get_match_content(self.identifier))))
             for match in self.matches]
 
         buffer = BytesIO()
@@ -20,7 +20,9 @@ and should not define:
     - url names
 
 '''
+from django.conf import settings
 from django.contrib.auth.views import PasswordResetView
+from django.db import transaction
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.views.generic.edit import ModelFormMixin
@@ -29,9 +31,9 @@ from callisto_core.accounts import (
     forms as account_forms, tokens as account_tokens,
 )
 from callisto_core.delivery import view_partials as delivery_partials
-from callisto_core.utils.api import MatchingApi, NotificationApi, TenantApi
+from callisto_core.utils.api import NotificationApi, TenantApi
 
-from . import forms, validators, view_helpers
+from . import forms, matching_helpers, validators, view_helpers
 
 
 class _SubmissionPartial(
@@ -137,9 +139,28 @@ class _MatchingPartial(
         kwargs.update({'matching_validators': self.get_matching_validators()})
         return kwargs
 
+    @property
+    def matching_in_background(self):
+        return getattr(settings, 'CALLISTO_MATCHING_ASYNC', False)
+
+    @property
+    def match_notification_helper(self):
+        return matching_helpers.MatchNotificationHelper(
+            report=self.report,
+            site_id=self.site_id,
+            admin_email_template_name=self.admin_email_template_name,
+            coordinator_emails=self.coordinator_emails,
+            coordinator_public_key=self.coordinator_public_key,
+        )
+
     def form_valid(self, form):
         response = super().form_valid(form)
         identifier = form.cleaned_data.get('identifier')
+
+        if self.matching_in_background and form.instance.pk:
+            self._enqueue_matching(form.instance, identifier)
+            return response
+
         matches = self._get_matches(identifier)
 
         self._notify_owner_of_submission(identifier)
@@ -151,46 +172,37 @@ class _MatchingPartial(
 
         return response
 
+    def _enqueue_matching(self, match_report, identifier):
+        from callisto_core.celeryconfig import tasks
+        match_report.matching_status = match_report.MATCHING_PENDING
+        match_report.save(update_fields=['matching_status'])
+        # the task can't claim a MatchReport that hasn't been committed yet
+        transaction.on_commit(lambda: tasks.find_matches.delay(
+            match_report_id=match_report.pk,
+            sealed_identifier=matching_helpers.seal_identifier(identifier),
+            site_id=self.site_id,
+            admin_email_template_name=self.admin_email_template_name,
+        ))
+
     def _get_matches(self, identifier):
-        return MatchingApi.find_matches(identifier)
+        return matching_helpers.find_matches(identifier, site_id=self.site_id)
 
     def _slack_match_notification(self):
-        NotificationApi.slack_notification(
-            msg='New Callisto Matches (details will be sent via email)',
-            type='match_confirmation',
-        )
+        self.match_notification_helper.slack_match_notification()
 
     def _match_confirmation_email_to_callisto(self, matches):
-        NotificationApi.send_with_kwargs(
-            site_id=self.site_id,  # required in general
-            email_template_name=self.admin_email_template_name,  # the email template
-            to_addresses=NotificationApi.ALERT_LIST,  # addresses to send to
-            matches=matches,  # used in the email body
-            email_subject='New Callisto Matches',  # rendered as the email subject
-            email_name='match_confirmation_callisto_team',  # used in test assertions
-        )
+        self.match_notification_helper.match_confirmation_email_to_callisto(
+            matches)
 
     def _notify_owner_of_submission(self, identifier):
-        if identifier:
-            NotificationApi.send_confirmation(
-                email_type='match_confirmation',
-                to_addresses=[self.report.contact_email],
-                site_id=self.site_id,
-            )
+        self.match_notification_helper.notify_owner_of_submission(identifier)
 
     def _notify_authority_of_matches(self, matches, identifier):
-        NotificationApi.send_matching_report_to_authority(
-            matches=matches,
-            identifier=identifier,
-            to_addresses=self.coordinator_emails,
-            public_key=self.coordinator_public_key,
-        )
+        self.match_notification_helper.notify_authority_of_matches(
+            matches, identifier)
 
     def _notify_owners_of_matches(self, matches):
-        for match in matches:
-            NotificationApi.send_match_notification(
-                match_report=match,
-            )
+        self.match_notification_helper.notify_owners_of_matches(matches)
 
 
 class OptionalMatchingPartial(
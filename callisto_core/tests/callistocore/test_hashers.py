@@ -1,11 +1,18 @@
 import base64
+import json
+import threading
+import time
+from io import StringIO
+from unittest.mock import patch
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
 from django.test import TestCase, override_settings
 from django.utils.encoding import force_bytes
 
 import callisto_core.delivery.hashers as hashers
+from callisto_core.delivery import kdf
 
 
 class KeyHasherFunctionsTest(TestCase):
@@ -57,6 +64,48 @@ class KeyHasherFunctionsTest(TestCase):
         self.assertIsInstance(hs.pop(), hashers.PBKDF2KeyHasher)
         self.assertIsInstance(hs.pop(), hashers.PBKDF2KeyHasher)
 
+    def test_hashers_are_only_built_once(self):
+        hashers.reset_hashers(setting='KEY_HASHERS')
+        with patch.object(
+            hashers, 'import_string', wraps=hashers.import_string,
+        ) as import_string:
+            hashers.get_hasher()
+            hashers.get_hasher('pbkdf2_sha256')
+            hashers.identify_hasher('')
+            hashers.make_key('', 'key', 'salt')
+        self.assertEqual(import_string.call_count, 2)
+
+    def test_hashers_reset_when_key_hashers_change(self):
+        self.assertIsInstance(hashers.get_hasher(), hashers.Argon2KeyHasher)
+        with override_settings(
+            KEY_HASHERS=['callisto_core.delivery.hashers.PBKDF2KeyHasher'],
+        ):
+            self.assertIsInstance(
+                hashers.get_hasher(), hashers.PBKDF2KeyHasher)
+            with self.assertRaises(ValueError):
+                hashers.get_hasher('argon2')
+        self.assertIsInstance(hashers.get_hasher(), hashers.Argon2KeyHasher)
+
+    def test_make_key_rederives_pbkdf2_keys(self):
+        encoded = hashers.PBKDF2KeyHasher().encode("key", "salt")
+        prefix, stretched_key = hashers.PBKDF2KeyHasher().split_encoded(
+            encoded)
+        self.assertEqual(
+            hashers.make_key(prefix, "key", None),
+            (prefix, stretched_key),
+        )
+
+    def test_make_key_uses_the_argon2_params_in_the_prefix(self):
+        hasher = hashers.Argon2KeyHasher()
+        params = {'time_cost': 1, 'memory_cost': 64, 'parallelism': 1}
+        prefix, stretched_key = hasher.derive('key', 'saltysalt', params)
+        self.assertEqual(
+            hashers.make_key(prefix, 'key', None),
+            (prefix, stretched_key),
+        )
+        self.assertNotEqual(
+            stretched_key, hasher.derive('key', 'saltysalt')[1])
+
 
 class PBKDF2KeyHasherTest(TestCase):
 
@@ -115,6 +164,20 @@ class PBKDF2KeyHasherTest(TestCase):
         prefix, stretched = self.hasher.split_encoded(encoded)
         self.assertEqual(len(stretched), 32)
 
+    def test_derive_matches_split_encoded(self):
+        self.assertEqual(
+            self.hasher.derive('key', 'a salt', {'iterations': 142}),
+            self.hasher.split_encoded(
+                self.hasher.encode('key', 'a salt', iterations=142)),
+        )
+
+    def test_params_from_prefix(self):
+        prefix, _ = self.hasher.derive('key', 'a salt', {'iterations': 142})
+        self.assertEqual(
+            self.hasher.params_from_prefix(prefix),
+            ({'iterations': 142}, 'a salt'),
+        )
+
 
 class Argon2KeyHasherTest(TestCase):
 
@@ -166,3 +229,162 @@ class Argon2KeyHasherTest(TestCase):
         encoded = self.hasher.encode("Yet Another Test Key", "salt for humans")
         prefix, stretched = self.hasher.split_encoded(encoded)
         self.assertEqual(len(stretched), 32)
+
+    def test_derive_matches_split_encoded(self):
+        self.assertEqual(
+            self.hasher.derive('key', 'a longer salt'),
+            self.hasher.split_encoded(self.hasher.encode('key', 'a longer salt')),
+        )
+
+    def test_params_from_prefix(self):
+        params = {
+            'time_cost': 1,
+            'memory_cost': 64,
+            'parallelism': 1,
+            'version': 19,
+        }
+        prefix, _ = self.hasher.derive('key', 'a longer salt', params)
+        self.assertEqual(
+            self.hasher.params_from_prefix(prefix),
+            (params, 'a longer salt'),
+        )
+
+
+class CalibrateKdfCommandTest(TestCase):
+
+    def calibrate(self, *args):
+        output = StringIO()
+        call_command(
+            'calibrate_kdf',
+            '--time-costs', '1', '2',
+            '--memory-costs', '8', '64',
+            '--parallelisms', '1',
+            '--iterations', '10', '20',
+            '--samples', '1',
+            *args,
+            stdout=output,
+        )
+        return json.loads(output.getvalue())
+
+    def test_reports_every_parameter_set(self):
+        results = self.calibrate()
+        self.assertEqual(len(results['argon2']), 4)
+        self.assertEqual(
+            [result['KEY_ITERATIONS'] for result in results['pbkdf2']],
+            [10, 20],
+        )
+        for result in results['argon2'] + results['pbkdf2']:
+            self.assertGreater(result['latency_ms'], 0)
+            self.assertGreater(result['peak_memory_kib'], 0)
+
+    def test_recommends_the_strongest_settings_within_budget(self):
+        results = self.calibrate(
+            '--memory-budget-mb', '1', '--concurrency', '8')
+        self.assertEqual(results['recommended'], {
+            'ARGON2_TIME_COST': 2,
+            'ARGON2_MEM_COST': 64,
+            'ARGON2_PARALLELISM': 1,
+            'KEY_ITERATIONS': 20,
+        })
+
+    def test_memory_budget_limits_recommendation(self):
+        results = self.calibrate(
+            '--memory-budget-mb', '0.5', '--concurrency', '16')
+        self.assertEqual(results['recommended']['ARGON2_MEM_COST'], 8)
+
+    def test_nothing_recommended_when_nothing_is_fast_enough(self):
+        results = self.calibrate('--target-ms', '0')
+        self.assertEqual(results['recommended'], {})
+
+
+@override_settings(
+    CALLISTO_KDF_MAX_CONCURRENCY=2,
+    CALLISTO_KDF_MAX_QUEUE=4,
+)
+class KdfExecutorTest(TestCase):
+
+    def setUp(self):
+        kdf.reset_stats()
+
+    def test_derivations_run_on_the_pool(self):
+        self.assertIsNot(
+            kdf.run(threading.current_thread), threading.current_thread())
+
+    def test_make_key_runs_on_the_pool(self):
+        hashers.make_key('', 'key', 'salt')
+        self.assertEqual(kdf.stats()['derivations'], 1)
+
+    def test_derive_key_runs_on_the_pool(self):
+        hasher = hashers.get_hasher()
+        self.assertEqual(
+            hashers.derive_key(hasher, 'key', 'saltysalt'),
+            hasher.derive('key', 'saltysalt'),
+        )
+        self.assertEqual(kdf.stats()['derivations'], 1)
+
+    def test_one_derivation_per_process_by_default(self):
+        with self.settings():
+            del settings.CALLISTO_KDF_MAX_CONCURRENCY
+            self.assertEqual(kdf.max_concurrency(), 1)
+
+    @override_settings(CALLISTO_KDF_MAX_CONCURRENCY=None)
+    def test_pool_can_be_disabled(self):
+        self.assertIs(
+            kdf.run(threading.current_thread), threading.current_thread())
+        self.assertEqual(kdf.stats()['derivations'], 0)
+
+    def test_nested_derivations_run_inline(self):
+        pool_thread, nested_thread = kdf.run(lambda: (
+            threading.current_thread(),
+            kdf.run(threading.current_thread),
+        ))
+        self.assertIs(pool_thread, nested_thread)
+
+    def test_concurrency_is_capped(self):
+        running = []
+        most_running = []
+        guard = threading.Lock()
+
+        def derivation():
+            with guard:
+                running.append(1)
+                most_running.append(len(running))
+            time.sleep(0.02)
+            with guard:
+                running.pop()
+
+        threads = [
+            threading.Thread(target=kdf.run, args=(derivation,))
+            for _ in range(6)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(max(most_running), 2)
+        self.assertEqual(kdf.stats()['derivations'], 6)
+        self.assertGreater(kdf.stats()['max_wait_seconds'], 0)
+
+    @override_settings(
+        CALLISTO_KDF_MAX_CONCURRENCY=1,
+        CALLISTO_KDF_MAX_QUEUE=0,
+        CALLISTO_KDF_QUEUE_TIMEOUT=0.01,
+    )
+    def test_full_queue_raises(self):
+        release = threading.Event()
+        started = threading.Event()
+
+        def slow_derivation():
+            started.set()
+            release.wait()
+
+        thread = threading.Thread(target=kdf.run, args=(slow_derivation,))
+        thread.start()
+        started.wait()
+        try:
+            with self.assertRaises(TimeoutError):
+                kdf.run(lambda: None)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(kdf.stats()['rejected'], 1)
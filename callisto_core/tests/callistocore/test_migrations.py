@@ -1,13 +1,19 @@
 import json
+from importlib import import_module
 from unittest import skip
 
 from django_migration_testcase import MigrationTest
 from mock import ANY, patch
 
+from django.apps import apps as global_apps
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
 from django.utils.crypto import get_random_string
 
+from callisto_core.accounts.models import Account
 from callisto_core.delivery import security
+from callisto_core.delivery.models import MatchReport, Report
 from callisto_core.reporting.report_delivery import MatchReportContent
 from callisto_core.utils.api import MatchingApi
 
@@ -145,3 +151,38 @@ class MultipleRecipientMigrationTest(MigrationTest):
         self.assertEqual(SentFullReport.objects.count(), 1)
         sent_report = SentFullReport.objects.first()
         self.assertEqual(sent_report.to_address, 'test@example.com')
+
+
+class MatchReportSiteIdMigrationTest(TestCase):
+
+    def test_site_id_is_backfilled_from_accounts(self):
+        migration = import_module(
+            'callisto_core.delivery.migrations.0043_matchreport_site_id')
+        user = User.objects.create_user(username="dummy", password="dummy")
+        Account.objects.create(user=user, site_id=3)
+        report = Report.objects.create(owner=user)
+        MatchReport.objects.create(report=report, encrypted=b'')
+        MatchReport.objects.create(
+            report=Report.objects.create(), encrypted=b'')
+
+        migration.backfill_site_id(
+            global_apps, connection.schema_editor())
+
+        self.assertEqual(
+            list(MatchReport.objects.order_by('pk').values_list(
+                'site_id', flat=True)),
+            [3, None],
+        )
+
+
+class MatchReportBucketMigrationTest(TestCase):
+
+    def test_buckets_are_cleared(self):
+        migration = import_module(
+            'callisto_core.delivery.migrations.0048_clear_matchreport_bucket')
+        MatchReport.objects.create(
+            report=Report.objects.create(), encrypted=b'', bucket='6:1')
+
+        migration.clear_buckets(global_apps, connection.schema_editor())
+
+        self.assertIsNone(MatchReport.objects.get().bucket)
@@ -1,7 +1,21 @@
+import json
+from io import StringIO
+from unittest.mock import patch
+
+import nacl.secret
+import nacl.utils
+
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.crypto import get_random_string
 
+from callisto_core.delivery import hashers, security
 from callisto_core.delivery.models import (
-    MatchReport, Report, SentFullReport, SentMatchReport,
+    MatchReport, RecordHistorical, Report, SentFullReport, SentMatchReport,
+    WizardSchema,
 )
 
 from .. import test_base
@@ -81,6 +95,285 @@ class ReportModelTest(test_base.ReportFlowHelper):
         self.assertFalse(Report.objects.first().match_found)
 
 
+class ReportDataKeyTest(test_base.ReportFlowHelper):
+    passphrase = 'this is my key'
+
+    def test_saves_reuse_the_salt(self):
+        report = Report(owner=self.user)
+        report.encrypt_record({'step': 1}, self.passphrase)
+        encode_prefix = report.encode_prefix
+
+        with patch.object(
+            hashers, 'derive_key', side_effect=AssertionError,
+        ):
+            report.encrypt_record({'step': 2}, self.passphrase)
+
+        self.assertEqual(report.encode_prefix, encode_prefix)
+        self.assertEqual(
+            Report.objects.get(pk=report.pk).decrypt_record(self.passphrase),
+            {'step': 2},
+        )
+
+    def test_stretched_key_saves_skip_key_derivation(self):
+        report = Report(owner=self.user)
+        report.encrypt_record({'step': 1}, self.passphrase)
+        stretched_key = report.stretched_key(self.passphrase)
+
+        with patch.object(
+            hashers, 'make_key', side_effect=AssertionError,
+        ), patch.object(
+            hashers, 'derive_key', side_effect=AssertionError,
+        ):
+            report.encrypt_record({'step': 2}, stretched_key)
+            self.assertEqual(
+                report.decrypt_record(stretched_key), {'step': 2})
+
+    def test_reports_without_data_keys_given_one_on_decrypt(self):
+        report = Report.objects.create(owner=self.user)
+        report.encode_prefix, key = hashers.derive_key(
+            hashers.get_hasher(), self.passphrase, get_random_string())
+        report.encrypted = security.encrypt_text(key, '{"old": "report"}')
+        report.save()
+        last_edited = report.last_edited
+
+        self.assertEqual(
+            report.decrypt_record(self.passphrase), {'old': 'report'})
+
+        report = Report.objects.get(pk=report.pk)
+        self.assertTrue(report.wrapped_key)
+        self.assertEqual(report.last_edited, last_edited)
+        self.assertEqual(
+            report.decrypt_record(self.passphrase), {'old': 'report'})
+
+    def test_old_key_parameters_upgraded_on_save(self):
+        report = Report(owner=self.user)
+        report.encrypt_record({'step': 1}, self.passphrase)
+        self.assertTrue(report.encode_prefix.startswith('argon2$'))
+
+        with override_settings(KEY_HASHERS=[
+            'callisto_core.delivery.hashers.PBKDF2KeyHasher',
+            'callisto_core.delivery.hashers.Argon2KeyHasher',
+        ]):
+            report.encrypt_record({'step': 2}, self.passphrase)
+            self.assertTrue(report.encode_prefix.startswith('pbkdf2_sha256$'))
+            self.assertEqual(
+                Report.objects.get(pk=report.pk).decrypt_record(
+                    self.passphrase),
+                {'step': 2},
+            )
+
+
+class ReportRekeyTest(test_base.ReportFlowHelper):
+    passphrase = 'this is my key'
+
+    def test_legacy_salt_reports_rekeyed_on_decrypt(self):
+        legacy_report = LegacyReportData()
+        legacy_report.encrypt_record('legacy text', key=self.passphrase)
+        report = Report.objects.create(
+            owner=self.user,
+            encrypted=legacy_report.encrypted,
+            salt=legacy_report.salt,
+        )
+
+        self.assertEqual(report.decrypt_record(self.passphrase), 'legacy text')
+
+        report = Report.objects.get(pk=report.pk)
+        self.assertIsNone(report.salt)
+        self.assertTrue(report.encode_prefix.startswith('argon2$'))
+        self.assertEqual(report.decrypt_record(self.passphrase), 'legacy text')
+
+    def test_old_hasher_reports_rekeyed_on_decrypt(self):
+        report = Report(owner=self.user)
+        with override_settings(KEY_HASHERS=[
+            'callisto_core.delivery.hashers.PBKDF2KeyHasher',
+            'callisto_core.delivery.hashers.Argon2KeyHasher',
+        ]):
+            report.encrypt_record({'old': 'hasher'}, self.passphrase)
+        encrypted = bytes(report.encrypted)
+
+        report = Report.objects.get(pk=report.pk)
+        self.assertEqual(
+            report.decrypt_record(self.passphrase), {'old': 'hasher'})
+
+        report = Report.objects.get(pk=report.pk)
+        self.assertTrue(report.encode_prefix.startswith('argon2$'))
+        # only the data key is rewrapped
+        self.assertEqual(bytes(report.encrypted), encrypted)
+
+    def test_stretched_keys_dont_rekey(self):
+        report = Report(owner=self.user)
+        with override_settings(KEY_HASHERS=[
+            'callisto_core.delivery.hashers.PBKDF2KeyHasher',
+            'callisto_core.delivery.hashers.Argon2KeyHasher',
+        ]):
+            report.encrypt_record({'old': 'hasher'}, self.passphrase)
+            stretched_key = report.stretched_key(self.passphrase)
+
+        report.decrypt_record(stretched_key)
+        report = Report.objects.get(pk=report.pk)
+        self.assertTrue(report.encode_prefix.startswith('pbkdf2_sha256$'))
+
+
+class CountLegacyKeysTest(test_base.ReportFlowHelper):
+
+    def test_counts_reports_with_old_hashers(self):
+        Report.objects.create(owner=self.user)  # never encrypted
+        Report(owner=self.user).encrypt_record({}, 'key')
+        with override_settings(KEY_HASHERS=[
+            'callisto_core.delivery.hashers.PBKDF2KeyHasher',
+            'callisto_core.delivery.hashers.Argon2KeyHasher',
+        ]):
+            Report(owner=self.user).encrypt_record({}, 'key')
+            Report(owner=self.user).encrypt_record({}, 'key')
+        Report.objects.create(owner=self.user, salt='legacy')
+
+        output = StringIO()
+        call_command('count_legacy_keys', stdout=output)
+        counts = json.loads(output.getvalue())
+
+        self.assertEqual(counts['Report'], {
+            'legacy': 3,
+            'by_algorithm': {'pbkdf2_sha256': 2, 'legacy': 1},
+        })
+        self.assertEqual(counts['MatchReport']['legacy'], 0)
+
+
+class ReportSaveTest(test_base.ReportFlowHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.report = Report(owner=self.user)
+        self.report.encrypt_record({'step': 1}, 'key')
+
+    def report_queries(self, queries):
+        return [
+            query['sql'] for query in queries
+            if 'delivery_report"' in query['sql'].split(' WHERE ')[0]
+        ]
+
+    def test_encrypt_record_updates_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.report.encrypt_record({'step': 2}, 'key')
+        update, = self.report_queries(queries)
+        self.assertTrue(update.startswith('UPDATE'))
+        self.assertNotIn('"contact_email"', update)
+
+    def test_flag_changes_dont_rewrite_encrypted_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.report.withdraw_from_matching()
+        update, = [
+            sql for sql in self.report_queries(queries)
+            if sql.startswith('UPDATE')
+        ]
+        self.assertIn('"match_found"', update)
+        self.assertIn('"last_edited"', update)
+        self.assertNotIn('"encrypted"', update)
+
+    def test_history_saved_with_new_reports(self):
+        self.assertEqual(
+            list(RecordHistorical.objects.values_list('record', flat=True)),
+            [self.report.pk],
+        )
+
+
+class WizardSchemaTest(test_base.ReportFlowHelper):
+    passphrase = 'this is my key'
+    forms = [[{'id': 1, 'question_text': 'a question'}]] * 40
+
+    def record(self, answer='an answer'):
+        return {
+            'data': {'question_1': answer},
+            'wizard_form_serialized': self.forms,
+        }
+
+    def user_decrypted_text(self, report):
+        data_key = security.unwrap_key(
+            report.stretched_key(self.passphrase).key, report.wrapped_key)
+        return security.decrypt_text(data_key, report.encrypted)
+
+    def test_records_reference_their_schema(self):
+        report = Report(owner=self.user)
+        report.encrypt_record(self.record(), self.passphrase)
+
+        stored = json.loads(self.user_decrypted_text(report))
+        schema = WizardSchema.objects.get()
+        self.assertEqual(stored, {
+            'data': {'question_1': 'an answer'},
+            'wizard_form_schema': schema.digest,
+        })
+        self.assertEqual(
+            Report.objects.get(pk=report.pk).decrypt_record(self.passphrase),
+            self.record(),
+        )
+
+    def test_schemas_are_shared(self):
+        Report(owner=self.user).encrypt_record(
+            self.record('first'), self.passphrase)
+        Report(owner=self.user).encrypt_record(
+            self.record('second'), self.passphrase)
+        self.assertEqual(WizardSchema.objects.count(), 1)
+
+    def test_records_with_inline_forms_readable(self):
+        report = Report(owner=self.user)
+        with patch.object(
+            WizardSchema, 'compact', side_effect=lambda data: data,
+        ):
+            report.encrypt_record(self.record(), self.passphrase)
+        self.assertIn(
+            'wizard_form_serialized', self.user_decrypted_text(report))
+
+        self.assertEqual(
+            Report.objects.get(pk=report.pk).decrypt_record(self.passphrase),
+            self.record(),
+        )
+        self.assertFalse(WizardSchema.objects.exists())
+
+
+class PayloadFormatTest(test_base.ReportFlowHelper):
+    key = b'k' * 32
+
+    def encrypt_plain(self, text):
+        # how text was encrypted before payloads
+        box = nacl.secret.SecretBox(self.key)
+        return box.encrypt(
+            text.encode('utf-8'),
+            nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE),
+        )
+
+    def test_text_is_compressed(self):
+        text = json.dumps([{'question_text': '<p>a question</p>'}] * 100)
+        encrypted = security.encrypt_text(self.key, text)
+        self.assertLess(len(encrypted), len(text) / 10)
+        self.assertEqual(security.decrypt_text(self.key, encrypted), text)
+
+    def test_uncompressed_text_readable(self):
+        encrypted = self.encrypt_plain('{"old": "format"}')
+        self.assertEqual(
+            security.decrypt_text(self.key, encrypted), '{"old": "format"}')
+
+    def test_unknown_payload_versions_rejected(self):
+        box = nacl.secret.SecretBox(self.key)
+        encrypted = box.encrypt(
+            security.PAYLOAD_MAGIC + bytes([99]) + b'data',
+            nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE),
+        )
+        with self.assertRaises(ValueError):
+            security.decrypt_text(self.key, encrypted)
+
+    def test_uncompressed_reports_readable(self):
+        report = Report.objects.create(owner=self.user)
+        report.encode_prefix, key = hashers.derive_key(
+            hashers.get_hasher(), 'key', get_random_string())
+        self.key = key
+        report.encrypted = self.encrypt_plain('{"old": "format"}')
+        report.save()
+
+        self.assertEqual(
+            Report.objects.get(pk=report.pk).decrypt_record('key'),
+            {'old': 'format'},
+        )
+
+
 class MatchReportTest(test_base.ReportFlowHelper):
 
     def setUp(self):
@@ -1,12 +1,14 @@
 from unittest import skip
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 from django.core import mail
 from django.core.management import call_command
 from django.test.utils import override_settings
 from django.urls import reverse
 
-from callisto_core.delivery import forms, models
+from callisto_core.delivery import (
+    forms, hashers, models, security, view_helpers,
+)
 from callisto_core.tests import test_base
 from callisto_core.wizard_builder.forms import PageForm
 
@@ -124,6 +126,155 @@ class NewReportFlowTest(test_base.ReportFlowHelper):
         self.assertIsInstance(form, forms.ReportAccessForm)
 
 
+class RequestDecryptionCacheTest(test_base.ReportFlowHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.client_post_report_creation()
+        self.client_post_answer_question()
+
+    def post_second_page(self):
+        url = reverse(
+            'report_update',
+            kwargs={'uuid': self.report.uuid, 'step': '1'},
+        )
+        return self.client.post(url, {'question_2': 'cupcake ipsum catsmeow'})
+
+    def test_wizard_step_stretches_and_decrypts_once(self):
+        with patch.object(
+            hashers, 'make_key', wraps=hashers.make_key,
+        ) as make_key, patch.object(
+            security, 'decrypt_text', wraps=security.decrypt_text,
+        ) as decrypt_text:
+            self.post_second_page()
+        self.assertEqual(make_key.call_count, 1)
+        self.assertEqual(decrypt_text.call_count, 1)
+
+    def test_cached_writes_are_saved(self):
+        self.post_second_page()
+        self.report.refresh_from_db()
+        self.assertEqual(
+            self.decrypted_report['data']['question_2'],
+            'cupcake ipsum catsmeow',
+        )
+        self.assertEqual(
+            self.decrypted_report['data']['question_3'],
+            'blanket ipsum pillowfight',
+        )
+
+
+class UnchangedStepWriteTest(test_base.ReportFlowHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.client_post_report_creation()
+        self.client_post_answer_question()
+        self.report.refresh_from_db()
+        view_helpers.reset_stats()
+
+    def post_first_page(self, answer):
+        url = reverse(
+            'report_update',
+            kwargs={'uuid': self.report.uuid, 'step': '0'},
+        )
+        return self.client.post(url, {'question_3': answer})
+
+    def test_unchanged_step_not_written(self):
+        encrypted = bytes(self.report.encrypted)
+        historical_count = models.RecordHistorical.objects.count()
+
+        self.post_first_page('blanket ipsum pillowfight')
+
+        self.report.refresh_from_db()
+        self.assertEqual(bytes(self.report.encrypted), encrypted)
+        self.assertEqual(
+            models.RecordHistorical.objects.count(), historical_count)
+        self.assertEqual(
+            view_helpers.stats(), {'writes': 0, 'skipped_writes': 1})
+
+    def test_changed_step_written(self):
+        self.post_first_page('an edited answer')
+
+        self.report.refresh_from_db()
+        self.assertEqual(
+            self.decrypted_report['data']['question_3'], 'an edited answer')
+        self.assertEqual(
+            view_helpers.stats(), {'writes': 1, 'skipped_writes': 0})
+
+
+@override_settings(CALLISTO_SESSION_KEY_STORAGE='stretched_key')
+class StretchedKeySessionTest(test_base.ReportFlowHelper):
+
+    def client_clear_stretched_keys(self):
+        session = self.client.session
+        session['stretched_keys'] = {}
+        session.save()
+
+    def test_report_creation_adds_stretched_key_to_session(self):
+        self.client_post_report_creation()
+        self.assertIsNone(self.client.session.get('passphrases'))
+        encode_prefix, salt, sealed_key = self.client.session.get(
+            'stretched_keys')[str(self.report.uuid)]
+        self.report.refresh_from_db()
+        self.assertEqual(encode_prefix, self.report.encode_prefix)
+        self.assertNotIn(self.passphrase, sealed_key)
+
+    def test_wizard_steps_skip_key_derivation(self):
+        self.client_post_report_creation()
+        with patch.object(
+            hashers, 'make_key', side_effect=AssertionError,
+        ), patch.object(
+            hashers, 'derive_key', side_effect=AssertionError,
+        ):
+            for step, data in [
+                ('0', {'question_3': 'blanket ipsum pillowfight'}),
+                ('1', {'question_2': 'cupcake ipsum catsmeow'}),
+            ]:
+                url = reverse(
+                    'report_update',
+                    kwargs={'uuid': self.report.uuid, 'step': step},
+                )
+                response = self.client.post(url, data, follow=True)
+                self.assertEqual(response.status_code, 200)
+            self.client_get_review()
+
+    def test_reports_saved_with_stretched_key_decrypt_with_passphrase(self):
+        self.client_post_report_creation()
+        self.client_post_answer_question()
+        self.report.refresh_from_db()
+        self.assertEqual(
+            self.report.decrypt_record(self.passphrase)['data']['question_3'],
+            self.data['question_3'],
+        )
+
+    def test_can_reenter_passphrase(self):
+        response = self.client_post_report_creation()
+        page_1_path = reverse(
+            'report_update', kwargs={'step': 0, 'uuid': self.report.uuid})
+        self.client_clear_stretched_keys()
+
+        response = self.client_post_report_access(page_1_path)
+        self.assertRedirects(response, page_1_path)
+        self.assertIn(
+            str(self.report.uuid),
+            self.client.session.get('stretched_keys'),
+        )
+
+    def test_stretched_key_for_old_salt_not_used(self):
+        response = self.client_post_report_creation()
+        self.report.refresh_from_db()
+        with override_settings(KEY_HASHERS=[
+            'callisto_core.delivery.hashers.PBKDF2KeyHasher',
+            'callisto_core.delivery.hashers.Argon2KeyHasher',
+        ]):
+            # upgrades the key parameters, with a new salt
+            self.report.encrypt_record({}, self.passphrase)
+
+        response = self.client.get(response.redirect_chain[0][0])
+        self.assertIsInstance(
+            response.context['form'], forms.ReportAccessForm)
+
+
 class ReportMetaFlowTest(test_base.ReportFlowHelper):
 
     def test_report_action_passthrough_request(self):
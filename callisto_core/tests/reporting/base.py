@@ -44,7 +44,14 @@ class MatchSetup(TestCase):
         for match in MatchReport.objects.all():
             assertion(match.match_found)
 
-    def create_match(self, user, identifier):
+    def assert_matches_found_for(self, identifier):
+        for match in MatchReport.objects.all():
+            if match.get_match(identifier):
+                self.assertTrue(match.match_found)
+            else:
+                self.assertFalse(match.match_found)
+
+    def create_match(self, user, identifier, find_matches=True):
         report = Report(owner=user)
         report.encrypt_record("test report 1", "key")
 
@@ -58,5 +65,5 @@ class MatchSetup(TestCase):
             identifier,
         )
 
-        matches = MatchingApi.find_matches(identifier)
-        return matches
+        if find_matches:
+            return MatchingApi.find_matches(identifier)
@@ -1,13 +1,28 @@
+import hashlib
+import hmac
 import json
-from unittest import skip
+from io import StringIO
+from unittest import skip, skipIf, skipUnless
 
 from mock import call, patch
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
-from callisto_core.delivery.models import MatchReport
+from callisto_core.accounts.models import Account
+from callisto_core.delivery import hashers, security
+from callisto_core.delivery.models import MatchReport, Report
+from callisto_core.reporting import matching_helpers, metrics
+from callisto_core.reporting.api import CallistoCoreMatchingApi
+from callisto_core.reporting.report_delivery import (
+    MatchReportContent, PDFMatchReport,
+)
+from callisto_core.tests.callistocore.models import LegacyMatchReportData
 from callisto_core.tests.reporting.base import MatchSetup
 from callisto_core.tests.test_base import ReportPostHelper
 from callisto_core.tests.utils.api import CustomNotificationApi
@@ -41,6 +56,712 @@ class MatchDiscoveryTest(MatchSetup):
         self.assert_matches_found_true()
 
 
+class MatchEpochTest(MatchSetup):
+
+    def test_match_reports_in_one_epoch_share_a_prefix(self):
+        self.create_match(self.user1, 'test1')
+        self.create_match(self.user2, 'test2')
+        prefixes = MatchReport.objects.values_list('encode_prefix', flat=True)
+        self.assertEqual(len(set(prefixes)), 1)
+
+    @override_settings(CALLISTO_MATCHING_EPOCH_LENGTH=None)
+    def test_epochs_can_be_disabled(self):
+        self.create_match(self.user1, 'test1')
+        self.create_match(self.user2, 'test2')
+        prefixes = MatchReport.objects.values_list('encode_prefix', flat=True)
+        self.assertEqual(len(set(prefixes)), 2)
+
+    def test_epoch_salt_changes_between_epochs(self):
+        week = 60 * 60 * 24 * 7
+        self.assertEqual(
+            MatchReport.epoch_salt(timestamp=week * 10),
+            MatchReport.epoch_salt(timestamp=week * 10 + 1),
+        )
+        self.assertNotEqual(
+            MatchReport.epoch_salt(timestamp=week * 10),
+            MatchReport.epoch_salt(timestamp=week * 11),
+        )
+
+    def test_identifier_stretched_once_per_epoch(self):
+        self.create_match(self.user1, 'test1')
+        self.create_match(self.user2, 'test2')
+        self.create_match(self.user3, 'test3')
+        with patch.object(
+            hashers, 'make_key', wraps=hashers.make_key,
+        ) as make_key:
+            MatchingApi.find_matches('test1')
+        self.assertEqual(make_key.call_count, 1)
+
+    def test_legacy_salt_reports_still_match(self):
+        self.create_match(self.user1, 'test1')
+        legacy_match_report = LegacyMatchReportData()
+        legacy_match_report.encrypt_match_report(
+            json.dumps(MatchReportContent(
+                identifier='test1', perp_name='test1',
+                email='test@example.com', phone="123",
+            ).__dict__),
+            'test1',
+        )
+        report = Report(owner=self.user2)
+        report.encrypt_record("test report 2", "key")
+        MatchReport.objects.create(
+            report=report,
+            encrypted=legacy_match_report.encrypted,
+            salt=legacy_match_report.salt,
+        )
+        matches = MatchingApi.find_matches('test1')
+        self.assertEqual(len(matches), 2)
+
+
+@override_settings(
+    CALLISTO_MATCHING_API='callisto_core.reporting.api.ParallelMatchingApi',
+    CALLISTO_MATCHING_EPOCH_LENGTH=None,
+    CALLISTO_MATCHING_WORKERS=2,
+)
+class ParallelMatchDiscoveryTest(MatchSetup):
+
+    def test_two_matching_reports_match(self):
+        self.create_match(self.user1, 'test1')
+        self.create_match(self.user2, 'test1')
+        self.assert_matches_found_true()
+
+    def test_non_matching_reports_dont_match(self):
+        self.create_match(self.user1, 'test1')
+        self.create_match(self.user2, 'test2')
+        self.assert_matches_found_false()
+
+    def test_multiple_matches(self):
+        self.create_match(self.user1, 'test1')
+        self.create_match(self.user2, 'test2')
+        matches = self.create_match(self.user3, 'test1')
+        self.assertEqual(
+            sorted(match.report.owner.username for match in matches),
+            ['test1', 'tset333'],
+        )
+
+    def test_rows_are_split_evenly(self):
+        self.assertEqual(
+            matching_helpers.split_evenly([1, 2, 3, 4, 5], 2),
+            [[1, 2, 3], [4, 5]],
+        )
+        self.assertEqual(matching_helpers.split_evenly([1], 2), [[1]])
+        self.assertEqual(matching_helpers.split_evenly([], 2), [])
+
+    def test_rows_sharing_an_epoch_salt_use_the_pool(self):
+        with self.settings():
+            del settings.CALLISTO_MATCHING_EPOCH_LENGTH
+            self.create_match(self.user1, 'test1', find_matches=False)
+            self.create_match(self.user2, 'test2', find_matches=False)
+            self.create_match(self.user3, 'test1', find_matches=False)
+            with patch.object(
+                matching_helpers, 'get_process_pool',
+                wraps=matching_helpers.get_process_pool,
+            ) as get_process_pool, patch.object(
+                MatchReport, 'stretch_identifier',
+                autospec=True, side_effect=MatchReport.stretch_identifier,
+            ) as stretch_identifier:
+                matches = MatchingApi.find_matches('test1')
+
+        self.assertEqual(len({
+            match_report.key_id for match_report in MatchReport.objects.all()
+        }), 1)
+        self.assertEqual(stretch_identifier.call_count, 1)
+        self.assertTrue(get_process_pool.called)
+        self.assertEqual(
+            sorted(match.report.owner.username for match in matches),
+            ['test1', 'tset333'],
+        )
+
+
+class StreamingMatchDiscoveryTest(MatchSetup):
+
+    def find_matches_queries(self, identifier):
+        with CaptureQueriesContext(connection) as context:
+            matches = MatchingApi.find_matches(identifier)
+        return matches, [query['sql'] for query in context.captured_queries]
+
+    def test_query_count_does_not_grow_with_match_reports(self):
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test1', find_matches=False)
+        _, few_queries = self.find_matches_queries('test1')
+
+        Report.objects.update(match_found=False)
+        self.create_match(self.user3, 'test1', find_matches=False)
+        self.create_match(self.user4, 'test1', find_matches=False)
+        self.create_match(self.user4, 'test2', find_matches=False)
+        matches, many_queries = self.find_matches_queries('test1')
+
+        self.assertEqual(len(matches), 4)
+        self.assertEqual(len(few_queries), len(many_queries))
+
+    def test_match_found_set_with_one_update(self):
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test1', find_matches=False)
+        self.create_match(self.user3, 'test1', find_matches=False)
+        _, queries = self.find_matches_queries('test1')
+
+        report_updates = [
+            sql for sql in queries
+            if sql.startswith('UPDATE "delivery_report"')
+        ]
+        self.assertEqual(len(report_updates), 1)
+        self.assert_matches_found_true()
+
+    def test_encrypted_report_body_not_loaded(self):
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test1', find_matches=False)
+        matches, _ = self.find_matches_queries('test1')
+
+        self.assertIn('encrypted', matches[0].report.get_deferred_fields())
+
+    @override_settings(CALLISTO_MATCHING_CHUNK_SIZE=1)
+    def test_small_chunks_still_match(self):
+        self.create_match(self.user1, 'test1')
+        self.create_match(self.user2, 'test2')
+        matches = self.create_match(self.user3, 'test1')
+        self.assertEqual(
+            sorted(match.report.owner.username for match in matches),
+            ['test1', 'tset333'],
+        )
+
+
+@override_settings(
+    CALLISTO_MATCHING_METRICS='callisto_core.reporting.metrics.InMemoryMatchingMetrics',
+    CALLISTO_MATCHING_EPOCH_LENGTH=None,
+)
+class MatchMetricsTest(MatchSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test2', find_matches=False)
+        self.create_match(self.user3, 'test1', find_matches=False)
+        metrics.InMemoryMatchingMetrics.reset()
+
+    def stage(self, stage):
+        measurements, = metrics.InMemoryMatchingMetrics.for_stage(stage)
+        return measurements
+
+    def test_each_transform_is_measured(self):
+        MatchingApi.find_matches('test1')
+        self.assertEqual(
+            [stage for stage, _ in metrics.InMemoryMatchingMetrics.records],
+            [
+                '_resolve_reports_decryptable_with_identifier',
+                '_backfill_identifier_metadata',
+                '_rekey_legacy_reports',
+                '_resolve_reports_with_duplicate_owners',
+                '_resolve_match_is_between_two_or_more_reports',
+                '_resolve_already_matched_reports',
+                '_update_match_found',
+                'find_matches',
+            ],
+        )
+        self.assertEqual(self.stage('find_matches')['rows_out'], 2)
+
+    def test_streamed_rows_are_counted(self):
+        MatchingApi.find_matches('test1')
+        decrypt = self.stage('_resolve_reports_decryptable_with_identifier')
+        self.assertEqual(decrypt['rows_in'], 3)
+        self.assertEqual(decrypt['rows_out'], 2)
+        self.assertGreater(decrypt['seconds'], 0)
+
+    def test_kdf_calls_and_decrypt_failures_are_counted(self):
+        MatchingApi.find_matches('test1')
+        decrypt = self.stage('_resolve_reports_decryptable_with_identifier')
+        self.assertEqual(decrypt['kdf_calls'], 3)
+        self.assertEqual(decrypt['decrypt_failures'], 1)
+        self.assertEqual(self.stage('find_matches')['kdf_calls'], 3)
+
+    def test_queries_are_counted(self):
+        MatchingApi.find_matches('test1')
+        self.assertEqual(self.stage('_update_match_found')['queries'], 1)
+        self.assertEqual(
+            self.stage('_resolve_reports_with_duplicate_owners')['queries'], 0)
+
+    def test_collector_errors_dont_break_matching(self):
+        with patch.object(
+            metrics.InMemoryMatchingMetrics, 'record', side_effect=ValueError,
+        ):
+            matches = MatchingApi.find_matches('test1')
+        self.assertEqual(len(matches), 2)
+
+    def test_measurements_are_discarded_by_default(self):
+        with self.settings():
+            del settings.CALLISTO_MATCHING_METRICS
+            collector = metrics.get_collector()
+        self.assertIs(type(collector), metrics.MatchingMetrics)
+
+    @override_settings(
+        CALLISTO_MATCHING_METRICS='callisto_core.reporting.metrics.LoggingMatchingMetrics',
+    )
+    def test_measurements_can_be_logged(self):
+        with self.assertLogs('callisto_core.reporting.metrics', 'INFO') as logs:
+            MatchingApi.find_matches('test1')
+        update_log, = [
+            output for output in logs.output
+            if 'matching._update_match_found ' in output
+        ]
+        self.assertIn('queries=1 rekeyed=0 rows_in=2 rows_out=2', update_log)
+
+    @override_settings(
+        CALLISTO_MATCHING_METRICS='callisto_core.reporting.metrics.StatsdMatchingMetrics',
+    )
+    def test_measurements_can_be_sent_to_statsd(self):
+        with patch('socket.socket') as socket:
+            MatchingApi.find_matches('test1')
+        sendto = socket.return_value.__enter__.return_value.sendto
+        packet, address = sendto.call_args[0]
+        self.assertEqual(address, ('localhost', 8125))
+        lines = packet.decode('utf-8').split('\n')
+        self.assertIn('callisto.matching.find_matches.rows_out:2|c', lines)
+        self.assertIn('callisto.matching.find_matches.kdf_calls:3|c', lines)
+        self.assertTrue(any(line.endswith('|ms') for line in lines))
+
+
+@override_settings(
+    CALLISTO_MATCHING_METRICS='callisto_core.reporting.metrics.InMemoryMatchingMetrics',
+)
+class MatchRekeyTest(MatchSetup):
+
+    def setUp(self):
+        super().setUp()
+        with override_settings(KEY_HASHERS=[
+            'callisto_core.delivery.hashers.PBKDF2KeyHasher',
+            'callisto_core.delivery.hashers.Argon2KeyHasher',
+        ]):
+            self.create_match(self.user1, 'test1', find_matches=False)
+            self.create_match(self.user2, 'test1', find_matches=False)
+            self.create_match(self.user3, 'test2', find_matches=False)
+        metrics.InMemoryMatchingMetrics.reset()
+
+    def prefixes(self):
+        return [
+            match_report.encode_prefix.split('$', 1)[0]
+            for match_report in MatchReport.objects.order_by('pk')
+        ]
+
+    def test_matched_reports_rekeyed_with_current_hasher(self):
+        MatchingApi.find_matches('test1')
+        self.assertEqual(
+            self.prefixes(), ['argon2', 'argon2', 'pbkdf2_sha256'])
+        self.assert_matches_found_for('test1')
+
+    def test_rekeyed_reports_share_a_stretch(self):
+        with patch.object(
+            hashers, 'derive_key', wraps=hashers.derive_key,
+        ) as derive_key:
+            MatchingApi.find_matches('test1')
+        self.assertEqual(derive_key.call_count, 1)
+        first, second, _ = MatchReport.objects.order_by('pk')
+        self.assertEqual(first.encode_prefix, second.encode_prefix)
+
+    def test_rekeyed_reports_are_counted(self):
+        MatchingApi.find_matches('test1')
+        rekey, = metrics.InMemoryMatchingMetrics.for_stage(
+            '_rekey_legacy_reports')
+        self.assertEqual(rekey['rekeyed'], 2)
+
+    def test_legacy_salt_reports_rekeyed(self):
+        legacy_data = LegacyMatchReportData()
+        legacy_data.encrypt_match_report('{"legacy": "report"}', 'test4')
+        match_report = MatchReport.objects.create(
+            report=Report.objects.create(owner=self.user4),
+            encrypted=legacy_data.encrypted,
+            salt=legacy_data.salt,
+        )
+        MatchingApi.find_matches('test4')
+        match_report.refresh_from_db()
+        self.assertIsNone(match_report.salt)
+        self.assertTrue(match_report.encode_prefix.startswith('argon2$'))
+        self.assertEqual(
+            match_report.get_match('test4'), '{"legacy": "report"}')
+
+
+@override_settings(CALLISTO_MATCHING_EPOCH_LENGTH=None)
+class MatchContentReuseTest(MatchSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test1', find_matches=False)
+
+    def test_matches_carry_their_decrypted_content(self):
+        matches = MatchingApi.find_matches('test1')
+        for match in matches:
+            self.assertEqual(
+                json.loads(match.decrypted_report)['identifier'], 'test1')
+
+    @override_settings(
+        CALLISTO_MATCHING_API='callisto_core.reporting.api.ParallelMatchingApi',
+        CALLISTO_MATCHING_WORKERS=2,
+    )
+    def test_parallel_matches_carry_their_decrypted_content(self):
+        matches = MatchingApi.find_matches('test1')
+        self.assertEqual(len(matches), 2)
+        for match in matches:
+            self.assertEqual(
+                json.loads(match.decrypted_report)['identifier'], 'test1')
+
+    def test_match_pdf_does_not_rederive_keys(self):
+        matches = MatchingApi.find_matches('test1')
+        with patch.object(
+            MatchReport, 'stretch_identifier', side_effect=AssertionError,
+        ):
+            pdf = PDFMatchReport(matches, 'test1').generate_match_report(
+                report_id='1', recipient='test@example.com')
+        self.assertTrue(pdf)
+
+    def test_content_falls_back_to_decrypting(self):
+        match_report = MatchReport.objects.first()
+        self.assertFalse(hasattr(match_report, 'decrypted_report'))
+        self.assertEqual(
+            json.loads(match_report.get_match_content('test1'))['identifier'],
+            'test1',
+        )
+        self.assertIsNone(match_report.get_match_content('test2'))
+
+
+class MatchManyTest(MatchSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test1', find_matches=False)
+        self.create_match(self.user3, 'test2', find_matches=False)
+        self.create_match(self.user4, 'test2', find_matches=False)
+
+    def test_matches_are_per_identifier(self):
+        matches = MatchingApi.find_matches_many(['test1', 'test2', 'test3'])
+        self.assertEqual(
+            {
+                identifier: sorted(
+                    match.report.owner.username for match in match_list)
+                for identifier, match_list in matches.items()
+            },
+            {
+                'test1': ['test1', 'tset22'],
+                'test2': ['tset333', 'tset4444'],
+                'test3': [],
+            },
+        )
+        self.assert_matches_found_true()
+
+    def test_each_match_report_is_read_once(self):
+        with CaptureQueriesContext(connection) as context, patch.object(
+            security, 'unpepper', wraps=security.unpepper,
+        ) as unpepper:
+            MatchingApi.find_matches_many(['test1', 'test2', 'test3'])
+        match_report_reads = [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith('SELECT') and
+            'FROM "delivery_matchreport"' in query['sql']
+        ]
+        self.assertEqual(len(match_report_reads), 1)
+        self.assertEqual(unpepper.call_count, 4)
+
+    def test_matches_many_agrees_with_find_matches(self):
+        matches = MatchingApi.find_matches_many(['test2'])
+        Report.objects.update(match_found=False)
+        self.assertEqual(
+            [match.pk for match in matches['test2']],
+            [match.pk for match in MatchingApi.find_matches('test2')],
+        )
+
+    def test_no_identifiers(self):
+        self.assertEqual(MatchingApi.find_matches_many([]), {})
+
+
+class MatchLockingTest(MatchSetup):
+
+    def setUp(self):
+        super().setUp()
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test1', find_matches=False)
+
+    def test_reports_matched_by_a_concurrent_run_are_skipped(self):
+        at_least_two = CallistoCoreMatchingApi.\
+            _resolve_match_is_between_two_or_more_reports
+
+        def concurrent_match(api, match_list):
+            # another worker finishes matching first
+            Report.objects.update(match_found=True)
+            return at_least_two(api, match_list)
+
+        with patch.object(
+            CallistoCoreMatchingApi,
+            '_resolve_match_is_between_two_or_more_reports',
+            autospec=True,
+            side_effect=concurrent_match,
+        ):
+            self.assertEqual(MatchingApi.find_matches('test1'), [])
+
+    @skipUnless(
+        connection.features.has_select_for_update, 'requires row locks')
+    def test_candidate_reports_are_locked(self):
+        with CaptureQueriesContext(connection) as context:
+            MatchingApi.find_matches('test1')
+        self.assertTrue(any(
+            'FOR UPDATE' in query['sql']
+            for query in context.captured_queries
+        ))
+
+    @skipIf(
+        connection.features.has_select_for_update, 'database has row locks')
+    def test_process_lock_held_while_matching(self):
+        lock_id = matching_helpers.lock_id('test1')
+        update_match_found = CallistoCoreMatchingApi._update_match_found
+
+        def assert_locked(api, match_list):
+            self.assertTrue(matching_helpers._process_locks[lock_id].locked())
+            return update_match_found(api, match_list)
+
+        with patch.object(
+            CallistoCoreMatchingApi,
+            '_update_match_found',
+            autospec=True,
+            side_effect=assert_locked,
+        ) as update:
+            MatchingApi.find_matches('test1')
+        self.assertTrue(update.called)
+        self.assertFalse(matching_helpers._process_locks[lock_id].locked())
+
+    @skipIf(
+        connection.features.has_select_for_update, 'database has row locks')
+    def test_trial_decryption_runs_outside_the_lock(self):
+        lock_id = matching_helpers.lock_id('test1')
+        resolve_decryptable = matching_helpers.resolve_decryptable
+
+        def assert_unlocked(identifier, match_reports):
+            lock = matching_helpers._process_locks.get(lock_id)
+            self.assertFalse(lock and lock.locked())
+            return resolve_decryptable(identifier, match_reports)
+
+        with patch.object(
+            matching_helpers,
+            'resolve_decryptable',
+            side_effect=assert_unlocked,
+        ) as resolve:
+            matches = MatchingApi.find_matches('test1')
+        self.assertTrue(resolve.called)
+        self.assertEqual(len(matches), 2)
+
+    @override_settings(CALLISTO_MATCHING_LOCKING=None)
+    def test_locking_can_be_disabled(self):
+        with patch.object(matching_helpers, 'process_lock') as process_lock:
+            matches = MatchingApi.find_matches('test1')
+        self.assertEqual(len(matches), 2)
+        self.assertFalse(process_lock.called)
+
+    def test_lock_ids_are_per_identifier(self):
+        self.assertNotEqual(
+            matching_helpers.lock_id('test1'),
+            matching_helpers.lock_id('test2'),
+        )
+        self.assertLess(matching_helpers.lock_id('test1'), 2 ** 32)
+
+
+class MatchBenchmarkTest(MatchSetup):
+
+    def test_benchmark_reports_hits_and_misses(self):
+        output = StringIO()
+        call_command(
+            'benchmark_matching', sizes=[3, 6], repeat=1, stdout=output)
+        results = json.loads(output.getvalue())['results']
+
+        self.assertEqual(
+            [(result['rows'], result['case'], result['matches'])
+             for result in results],
+            [(3, 'hit', 3), (3, 'miss', 0), (6, 'hit', 3), (6, 'miss', 0)],
+        )
+        decrypt_stage = results[0]['stages'][
+            '_resolve_reports_decryptable_with_identifier']
+        self.assertEqual(decrypt_stage['rows_in'], 3)
+        self.assertEqual(decrypt_stage['rows_out'], 3)
+
+    def test_each_run_starts_from_the_seeded_rows(self):
+        output = StringIO()
+        call_command(
+            'benchmark_matching', sizes=[3, 6], repeat=2, stdout=output)
+        results = json.loads(output.getvalue())['results']
+
+        for result in results:
+            if result['case'] == 'hit':
+                # the pbkdf2 and legacy salt hits
+                self.assertEqual(
+                    result['stages']['_rekey_legacy_reports']['rekeyed'], 2)
+
+    def test_benchmark_data_is_rolled_back(self):
+        call_command(
+            'benchmark_matching', sizes=[3], repeat=1, stdout=StringIO())
+        self.assertEqual(MatchReport.objects.count(), 0)
+        self.assertEqual(Report.objects.count(), 0)
+
+
+@override_settings(
+    CALLISTO_MATCHING_API='callisto_core.reporting.api.BucketedMatchingApi',
+)
+class BucketedMatchDiscoveryTest(MatchSetup):
+
+    def test_two_matching_reports_match(self):
+        self.create_match(self.user1, 'test1')
+        self.create_match(self.user2, 'test1')
+        self.assert_matches_found_true()
+
+    def test_match_reports_record_their_bucket(self):
+        self.create_match(self.user1, 'test1')
+        self.assertEqual(
+            MatchReport.objects.get().bucket,
+            MatchReport.bucket_for('test1'),
+        )
+
+    def test_buckets_are_not_keyed_with_the_pepper(self):
+        pepper_digest = hmac.new(
+            settings.PEPPER, b'test1', hashlib.sha256).digest()
+        self.assertNotEqual(
+            security.bucket('test1', 32),
+            '32:{}'.format(int.from_bytes(pepper_digest[:4], 'big')),
+        )
+
+    def test_buckets_are_coarse(self):
+        buckets = {
+            MatchReport.bucket_for(f'identifier {index}')
+            for index in range(1000)
+        }
+        self.assertLessEqual(len(buckets), 2 ** 6)
+
+    def test_only_same_bucket_reports_are_decrypted(self):
+        self.create_match(self.user1, 'test1')
+        self.create_match(self.user2, 'test2')
+        MatchReport.objects.filter(
+            report__owner=self.user2,
+        ).update(bucket='6:not a real bucket')
+        with patch.object(
+            MatchReport, 'get_match_with_key',
+            autospec=True, side_effect=MatchReport.get_match_with_key,
+        ) as get_match_with_key:
+            MatchingApi.find_matches('test1')
+        self.assertEqual(get_match_with_key.call_count, 1)
+
+    @override_settings(CALLISTO_MATCHING_BUCKET_BITS=3)
+    def test_reports_from_other_bucket_widths_still_match(self):
+        with override_settings(CALLISTO_MATCHING_BUCKET_BITS=5):
+            self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test1')
+        self.assert_matches_found_true()
+
+    def test_buckets_are_backfilled_by_matching(self):
+        self.create_match(self.user1, 'test1', find_matches=False)
+        MatchReport.objects.update(bucket=None)
+        self.create_match(self.user2, 'test1')
+        self.assert_matches_found_true()
+        self.assertEqual(
+            set(MatchReport.objects.values_list('bucket', flat=True)),
+            {MatchReport.bucket_for('test1')},
+        )
+
+
+class MatchBucketSettingTest(MatchSetup):
+
+    def test_no_bucket_without_the_bucketed_api(self):
+        self.create_match(self.user1, 'test1')
+        self.assertIsNone(MatchReport.objects.get().bucket)
+
+    @override_settings(CALLISTO_MATCHING_BUCKET_BITS=4)
+    def test_buckets_can_be_enabled_by_setting(self):
+        self.create_match(self.user1, 'test1')
+        self.assertEqual(
+            MatchReport.objects.get().bucket,
+            security.bucket('test1', 4),
+        )
+
+
+class SiteScopedMatchDiscoveryTest(MatchSetup):
+
+    def setUp(self):
+        super().setUp()
+        Account.objects.create(user=self.user1, site_id=1)
+        Account.objects.create(user=self.user2, site_id=2)
+        Account.objects.create(user=self.user3, site_id=1)
+
+    def test_match_reports_record_the_owners_site(self):
+        self.create_match(self.user1, 'test1')
+        self.create_match(self.user4, 'test1')
+        self.assertEqual(
+            MatchReport.objects.get(report__owner=self.user1).site_id, 1)
+        self.assertIsNone(
+            MatchReport.objects.get(report__owner=self.user4).site_id)
+
+    def test_matching_is_scoped_to_one_site(self):
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test1', find_matches=False)
+        self.assertFalse(MatchingApi.find_matches('test1', site_id=2))
+        self.create_match(self.user3, 'test1', find_matches=False)
+        matches = MatchingApi.find_matches('test1', site_id=1)
+        self.assertEqual(
+            {match.report.owner for match in matches},
+            {self.user1, self.user3},
+        )
+
+    def test_reports_without_a_site_are_still_matched(self):
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user4, 'test1', find_matches=False)
+        matches = MatchingApi.find_matches('test1', site_id=1)
+        self.assertEqual(len(matches), 2)
+
+    def test_site_id_is_passed_to_the_matching_api(self):
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test1', find_matches=False)
+        self.assertFalse(matching_helpers.find_matches('test1', site_id=2))
+
+    @override_settings(
+        CALLISTO_MATCHING_API='callisto_core.tests.utils.api.UnscopedMatchingApi',
+    )
+    def test_apis_without_a_site_id_are_unscoped(self):
+        self.create_match(self.user1, 'test1', find_matches=False)
+        self.create_match(self.user2, 'test1', find_matches=False)
+        matches = matching_helpers.find_matches('test1', site_id=2)
+        self.assertEqual(len(matches), 2)
+
+
+class IdentifierDomainMatchDiscoveryTest(MatchSetup):
+
+    def test_match_reports_record_their_identifier_domain(self):
+        self.create_match(self.user1, 'twitter:callisto')
+        self.create_match(self.user2, 'callisto')
+        self.assertEqual(
+            MatchReport.objects.get(report__owner=self.user1).identifier_domain,
+            'twitter',
+        )
+        self.assertEqual(
+            MatchReport.objects.get(report__owner=self.user2).identifier_domain,
+            '',
+        )
+
+    def test_only_same_domain_reports_are_decrypted(self):
+        self.create_match(self.user1, 'twitter:callisto')
+        self.create_match(self.user2, 'callisto', find_matches=False)
+        self.create_match(self.user3, 'callisto', find_matches=False)
+        with patch.object(
+            MatchReport, 'get_match_with_key',
+            autospec=True, side_effect=MatchReport.get_match_with_key,
+        ) as get_match_with_key:
+            matches = MatchingApi.find_matches('callisto')
+        self.assertEqual(len(matches), 2)
+        self.assertEqual(get_match_with_key.call_count, 2)
+
+    def test_identifier_domains_are_backfilled_by_matching(self):
+        self.create_match(self.user1, 'twitter:callisto', find_matches=False)
+        MatchReport.objects.update(identifier_domain=None)
+        self.create_match(self.user2, 'twitter:callisto')
+        self.assert_matches_found_true()
+        self.assertEqual(
+            set(MatchReport.objects.values_list(
+                'identifier_domain', flat=True)),
+            {'twitter'},
+        )
+
+
 class MatchIntegratedTest(
     MatchSetup,
     ReportPostHelper,
@@ -32,6 +32,14 @@ class CustomMatchingApi(
     pass
 
 
+class UnscopedMatchingApi(
+    CallistoCoreMatchingApi,
+):
+
+    def find_matches(self, identifier):
+        return super().find_matches(identifier)
+
+
 class CustomTenantApi(
     CallistoCoreTenantApi,
 ):